@@ -0,0 +1,183 @@
+"""
+A view that runs several requests to other views in one go, so that a
+client that needs lots of small json responses can fetch them with a
+single round trip.
+"""
+import copy
+import json
+from cStringIO import StringIO
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import django.http as http
+from django.core.urlresolvers import resolve, Resolver404
+from django.utils.datastructures import MultiValueDict
+
+import decorators
+
+logger = logging.getLogger('dj_utils.batch')
+
+# Request headers that would change the encoding of a sub-response, in
+# ways that stop us including it in the batch response.
+_STRIPPED_HEADERS = (
+    'HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE',
+    )
+
+def batch_view(max_requests=20, threads=0, methods=('GET',)):
+    """
+    Returns a view that accepts a POST of a json list of sub-requests
+    (or an object with the list as 'requests'), each of the form:
+
+        {"method": "GET", "path": "/photos/12/", "params": {"size": 2}}
+
+    where 'method' defaults to GET and 'params' to no parameters. Each
+    is resolved with the URLconf and dispatched to its view in-process,
+    and the results are returned as a json_response with a 'results'
+    list, holding a {"status": ..., "body": ...} object for each
+    sub-request, in order. Json bodies are decoded, so the 'ok' and
+    status conventions of json_response views come through unchanged.
+
+    Sub-requests are copies of the batch request, so they have the same
+    user, session and cookies, but they don't go through middleware.
+    No more than 'max_requests' sub-requests are accepted, and only the
+    given HTTP methods are allowed. If 'threads' is given, sub-requests
+    run in parallel on a pool of that many threads.
+    """
+    # The pool is created when first needed, and then reused.
+    pool = []
+    pool_lock = threading.Lock()
+
+    @decorators.method_required('POST')
+    @decorators.json_response()
+    def _batch(request):
+        try:
+            sub_requests = json.loads(request.body)
+        except ValueError:
+            return dict(ok=False, status=400, error='Invalid json.')
+        if isinstance(sub_requests, dict):
+            sub_requests = sub_requests.get('requests')
+        if not isinstance(sub_requests, list) or \
+                not all(isinstance(sub, dict) for sub in sub_requests):
+            return dict(ok=False, status=400, error='Expected a list.')
+        if len(sub_requests) > max_requests:
+            return dict(
+                ok=False, status=400,
+                error='No more than %d requests allowed.' % max_requests
+                )
+
+        def _run(sub):
+            return _dispatch(request, sub, methods, _batch)
+        if threads and len(sub_requests) > 1:
+            with pool_lock:
+                if not pool:
+                    pool.append(ThreadPool(threads))
+            results = pool[0].map(_run_in_thread, [
+                (_run, sub) for sub in sub_requests
+                ])
+        else:
+            results = map(_run, sub_requests)
+        return dict(results=results)
+    return _batch
+
+def _run_in_thread(args):
+    """
+    Runs a sub-request in a pool thread, closing the thread's database
+    connections afterwards, as django does at the end of a request.
+    """
+    from django.db import connections
+    function, sub = args
+    try:
+        return function(sub)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+def _dispatch(request, sub, methods, batch):
+    """
+    Runs a single sub-request, and returns its result object.
+    """
+    method = sub.get('method', 'GET')
+    path = sub.get('path')
+    params = sub.get('params') or {}
+    if not isinstance(method, basestring):
+        return dict(status=400, body=None)
+    try:
+        method = str(method).upper()
+    except UnicodeError:
+        return dict(status=400, body=None)
+    if method not in methods:
+        return dict(status=405, body=None)
+    if not isinstance(path, basestring) or not isinstance(params, dict):
+        return dict(status=400, body=None)
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return dict(status=404, body=None)
+    if match.func is batch:
+        return dict(status=400, body=None)
+
+    sub_request = _make_request(request, method, path, params)
+    try:
+        response = match.func(sub_request, *match.args, **match.kwargs)
+    except http.Http404:
+        return dict(status=404, body=None)
+    except Exception:
+        logger.exception("Error in batched request for '%s'", path)
+        return dict(status=500, body=None)
+    return dict(status=response.status_code, body=_response_body(response))
+
+def _make_request(request, method, path, params):
+    """
+    Returns a copy of the batch request, changed to have the given
+    method, path and parameters. For methods other than GET, the
+    parameters are the form encoded body, replacing the batch's.
+    """
+    query = http.QueryDict('', mutable=True)
+    for key, value in params.items():
+        if isinstance(value, list):
+            query.setlist(key, [unicode(item) for item in value])
+        else:
+            query[key] = unicode(value)
+
+    sub_request = copy.copy(request)
+    sub_request.method = method
+    sub_request.path = sub_request.path_info = path
+    sub_request.META = dict(request.META)
+    for header in _STRIPPED_HEADERS:
+        sub_request.META.pop(header, None)
+    sub_request.META['REQUEST_METHOD'] = method
+    sub_request.META['PATH_INFO'] = path
+    if method == 'GET':
+        body = ''
+        sub_request.META['QUERY_STRING'] = query.urlencode()
+        sub_request.META['CONTENT_TYPE'] = ''
+        sub_request.GET = query
+        sub_request.POST = http.QueryDict('')
+    else:
+        body = query.urlencode()
+        sub_request.META['QUERY_STRING'] = ''
+        sub_request.META['CONTENT_TYPE'] = \
+            'application/x-www-form-urlencoded'
+        sub_request.GET = http.QueryDict('')
+        sub_request.POST = query
+    sub_request.META['CONTENT_LENGTH'] = str(len(body))
+    sub_request._body = body
+    sub_request._stream = StringIO(body)
+    sub_request._read_started = False
+    sub_request._files = MultiValueDict()
+    return sub_request
+
+def _response_body(response):
+    """
+    Returns the body of a sub-response, decoded if it is json.
+    """
+    content = ''.join(response)
+    content_type = response.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        try:
+            return json.loads(content)
+        except ValueError:
+            pass
+    return content.decode('utf-8', 'replace')
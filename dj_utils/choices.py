@@ -1,6 +1,192 @@
+import threading
 import collections
 
-class Choices(object):
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+
+class _PredicateCache(object):
+    """
+    The results of values_where, by predicate. Only the most recently
+    used 'size' predicates are kept, so passing a new lambda each time
+    doesn't grow the cache without limit.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+
+    def __getstate__(self):
+        # Copies start empty, with a lock of their own.
+        return dict(size=self.size)
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+    def __contains__(self, predicate):
+        return predicate in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, predicate):
+        """
+        Returns the cached result for the predicate, or None.
+        """
+        with self.lock:
+            values = self.results.pop(predicate, None)
+            if values is not None:
+                self.results[predicate] = values
+            return values
+
+    def set(self, predicate, values):
+        """
+        Caches the result for the predicate, forgetting the least
+        recently used one if the cache is full.
+        """
+        with self.lock:
+            self.results.pop(predicate, None)
+            self.results[predicate] = values
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+class _ChoicesBase(object):
+    """
+    The lookups shared by Choices and its compiled form. These only
+    rely on the lookup tables, which can live either on the instance
+    or on the class.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        """
+        Returns the number of choices.
+        """
+        return len(self._choices)
+
+    def __iter__(self):
+        """
+        Returns the iterator over the choices. This method allows
+        instances of this class to be used as the choices= parameter
+        of django fields.
+        """
+        return iter(self._choices)
+
+    def __getitem__(self, value):
+        """
+        Returns the string associated with the given value.
+        """
+        return self.value_to_string(value)
+
+    def value_to_string(self, value):
+        """
+        Returns the string from the given value.
+        """
+        return self._val2str[value]
+
+    def value_to_data(self, value, data_type, default=None):
+        """
+        Returns a piece of additional data for the given data.
+        """
+        return self._val2data[value].get(data_type, default)
+
+    def data_to_value(self, data_type, data_value, default=None):
+        """
+        Returns the value for a piece of additional data.
+        """
+        return self._data2val.get(data_type, {}).get(data_value, default)
+
+    def values_with(self, data_type, data_value):
+        """
+        Returns the frozenset of all values whose additional data has
+        the given value for the given data type. Unlike data_to_value,
+        this works when more than one choice shares the data.
+        """
+        return self._data_index.get(data_type, {}).get(
+            data_value, frozenset()
+            )
+
+    def values_where(self, predicate):
+        """
+        Returns the frozenset of all values whose additional data
+        dictionary passes the given predicate. The results for the most
+        recently used predicates are cached, so it is best to define the
+        function once (e.g. at module level), rather than passing a new
+        lambda each time.
+        """
+        values = self._predicate_cache.get(predicate)
+        if values is None:
+            values = frozenset(
+                value for value, data in self._val2data.items()
+                if predicate(data)
+                )
+            self._predicate_cache.set(predicate, values)
+        return values
+
+    def filter_q(self, field_name, data_type=None, data_value=None,
+                 predicate=None):
+        """
+        Returns a Q object that filters the given choice field to the
+        values with the given piece of additional data (see
+        values_with), or that pass the given predicate (see
+        values_where). One of data_type or predicate must be given.
+        """
+        from django.db.models import Q
+        if data_type is None and predicate is None:
+            raise TypeError("filter_q needs a data_type or a predicate.")
+        if predicate is not None:
+            values = self.values_where(predicate)
+        else:
+            values = self.values_with(data_type, data_value)
+        return Q(**{'%s__in' % field_name: values})
+
+    def display_sql(self, column, data_type=None, default=None):
+        """
+        Returns a tuple of (sql, params) for a CASE expression that
+        maps the values in the given (already quoted) column to their
+        readable strings, or to the given piece of additional data if
+        data_type is given. Values with no match map to the default.
+        String (and lazy translated) labels are passed as unicode, and
+        any others, such as numbers, as they are.
+        """
+        sql = ['CASE %s' % column]
+        params = []
+        for value, name, string in (trip[:3] for trip in self._choice_data):
+            if data_type is None:
+                label = string
+            else:
+                label = self.value_to_data(value, data_type, default)
+            if isinstance(label, (basestring, Promise)):
+                label = force_unicode(label)
+            sql.append('WHEN %s THEN %s')
+            params.extend([value, label])
+        sql.append('ELSE %s END')
+        params.append(default)
+        return ' '.join(sql), params
+
+    def annotate_display(self, queryset, field_name, alias=None,
+                         data_type=None, default=None):
+        """
+        Returns the queryset with an extra selected column holding the
+        readable string for the given choice field, calculated in the
+        database. The column is called '<field_name>_display' unless
+        an alias is given, and can be used in values() and
+        values_list(), so list views never need to create model
+        instances just to display the choice. If data_type is given,
+        the column holds that piece of additional data instead.
+        """
+        from django.db import connections
+        opts = queryset.model._meta
+        quote_name = connections[queryset.db].ops.quote_name
+        column = '%s.%s' % (
+            quote_name(opts.db_table),
+            quote_name(opts.get_field(field_name).column)
+            )
+        sql, params = self.display_sql(column, data_type, default)
+        if alias is None:
+            alias = '%s_display' % field_name
+        return queryset.extra(select={alias: sql}, select_params=params)
+
+class Choices(_ChoicesBase):
     """
     A class that can act as a set of choices for a Django model, but
     is also useful as an enumerated type.
@@ -29,7 +215,7 @@ class Choices(object):
             del kws['inherit']
 
             # Extend the inherited data.
-            choice_data = other_choice._choice_data + choice_data
+            choice_data = tuple(other_choice._choice_data) + choice_data
 
             # Check if we need to sort.
             sort = True
@@ -37,7 +223,7 @@ class Choices(object):
                 sort = kws['sort']
                 del kws['sort']
             if sort:
-                choice_data = sorted(choice_data)
+                choice_data = tuple(sorted(choice_data))
 
         # Any other keyword argument we ignore.
         if kws:
@@ -57,27 +243,26 @@ class Choices(object):
         # Additional data.
         self._val2data = dict()
         self._data2val = collections.defaultdict(dict)
+        data_index = collections.defaultdict(
+            lambda: collections.defaultdict(set)
+            )
         for trip in choice_data:
             if len(trip) > 3:
                 self._val2data[trip[0]] = trip[3]
                 for key, val in trip[3].items():
                     self._data2val[key][val] = trip[0]
+                    data_index[key][val].add(trip[0])
             else:
                 self._val2data[trip[0]] = dict()
 
-    def __len__(self):
-        """
-        Returns the number of choices.
-        """
-        return len(self._choices)
-
-    def __iter__(self):
-        """
-        Returns the iterator over the choices. This method allows
-        instances of this class to be used as the choices= parameter
-        of django fields.
-        """
-        return iter(self._choices)
+        # The inverted index of all values with each piece of
+        # additional data, and the cache of predicate results.
+        self._data_index = dict()
+        for key, index in data_index.items():
+            self._data_index[key] = dict(
+                (val, frozenset(values)) for val, values in index.items()
+                )
+        self._predicate_cache = _PredicateCache()
 
     def __getattr__(self, name):
         """
@@ -89,26 +274,48 @@ class Choices(object):
         except KeyError:
             raise AttributeError(name)
 
-    def __getitem__(self, value):
+    def compile(self):
         """
-        Returns the string associated with the given value.
+        Returns a compiled version of these choices. This is an
+        instance of a class generated for these choices, where each
+        name is a real class attribute, so MY_CHOICES.MY_VALUE is a
+        plain attribute load rather than a call to __getattr__. The
+        instance itself has no storage (it uses __slots__), and the
+        lookup tables are shared on the class.
         """
-        return self.value_to_string(value)
+        reserved = set(dir(CompiledChoices))
+        for name in self._name2val:
+            if name in reserved:
+                raise ValueError(
+                    "Choice name '%s' can't be used in compiled "
+                    "choices." % name
+                    )
 
-    def value_to_string(self, value):
-        """
-        Returns the string from the given value.
-        """
-        return self._val2str[value]
+        attrs = dict(self._name2val)
+        attrs.update(
+            __slots__=(),
+            _choice_data=tuple(self._choice_data),
+            _choices=tuple(self._choices),
+            _name2val=dict(self._name2val),
+            _val2str=dict(self._val2str),
+            _val2data=dict(self._val2data),
+            _data2val=dict(self._data2val),
+            _data_index=self._data_index,
+            _predicate_cache=_PredicateCache()
+            )
+        return type('CompiledChoices', (CompiledChoices,), attrs)()
 
-    def value_to_data(self, value, data_type, default=None):
-        """
-        Returns a piece of additional data for the given data.
-        """
-        return self._val2data[value].get(data_type, default)
+class CompiledChoices(_ChoicesBase):
+    """
+    The base class for compiled choices, see Choices.compile. This
+    class isn't instantiated directly.
+    """
+    __slots__ = ()
 
-    def data_to_value(self, data_type, data_value, default=None):
-        """
-        Returns the value for a piece of additional data.
-        """
-        return self._data2val[data_type].get(data_value, default)
+def compile_choices(*choice_data, **kws):
+    """
+    Creates compiled choices in one step. This takes the same
+    arguments as Choices, and returns the result of its compile
+    method.
+    """
+    return Choices(*choice_data, **kws).compile()
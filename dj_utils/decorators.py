@@ -1,20 +1,60 @@
+import os
 import sys
+import copy
+import time
+import random
+import pstats
+import cProfile
+import tempfile
 import traceback
 import functools
+import threading
+import hashlib
+import itertools
 import json
+import logging
 import cgi
+import re
+import zlib
 
 import django.http as http
 import django.shortcuts as shortcuts
 import django.template as template
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.safestring import mark_safe
+from django.utils.text import compress_string
+
+import encoders
+import replicas
+
+logger = logging.getLogger('dj_utils.decorators')
+
+# Django 1.5 added a separate response class for streamed content,
+# before that a normal response streams when given an iterator.
+StreamingHttpResponse = getattr(
+    http, 'StreamingHttpResponse', http.HttpResponse
+    )
 
 # Method enforcement.
-def method_required(*methods):
+def method_required(*methods, **options):
     """
     A parameterized decorator that requires requests to have a
-    particular method.
+    particular method. Views that only read can pass replica=True (or
+    the alias of a database) to read from a replica, see
+    replicas.use_replica.
     """
+    replica = options.pop('replica', None)
+    if options:
+        raise TypeError(
+            "Unknown option for method_required: '%s'" % options.keys()[0]
+            )
     def _decorator(function):
+        if replica:
+            function = replicas.use_replica(
+                'replica' if replica is True else replica
+                )(function)
+
         @functools.wraps(function)
         def _wrapper(request, *args, **kws):
             if request.method not in methods:
@@ -30,129 +70,1013 @@ GET_required = method_required('GET')
 PUT_required = method_required('PUT')
 POST_or_PUT_required = method_required('POST', 'PUT')
 
+def _is_streaming(response):
+    """
+    Returns True if the response content is an iterator, which can
+    only be consumed once.
+    """
+    return getattr(response, 'streaming', False) or \
+        getattr(response, '_base_content_is_iter', False)
+
+# Load shedding.
+def concurrency_limit(limit, queue_timeout=0, max_queue=None,
+                      retry_after=1):
+    """
+    A parameterized decorator that allows at most 'limit' requests to
+    run the view at the same time (across the threads of one process).
+    Other requests wait for up to 'queue_timeout' seconds for a slot,
+    as long as no more than 'max_queue' requests are already waiting
+    (None means no limit). Requests that don't get a slot receive a
+    503 json response, with a Retry-After header of 'retry_after'
+    seconds, without the view being called.
+
+    The decorated view has a 'limit_stats' attribute, counting the
+    requests that were 'accepted', the number of those that had to
+    wait ('queued'), and those that were 'rejected'. For a streamed
+    response, the limit only covers the view, not sending the content.
+    """
+    def _decorator(function):
+        limiter = _Limiter(limit, max_queue)
+        stats = Counters('accepted', 'queued', 'rejected')
+
+        @functools.wraps(function)
+        def _wrapper(request, *args, **kws):
+            acquired = limiter.acquire(queue_timeout)
+            if not acquired:
+                stats.increment('rejected')
+                response = http.HttpResponse(
+                    json.dumps(dict(ok=False, error='Too many requests.')),
+                    content_type="application/json",
+                    status=503
+                    )
+                response['Retry-After'] = str(retry_after)
+                return response
+            stats.increment('accepted')
+            if acquired == _Limiter.QUEUED:
+                stats.increment('queued')
+            try:
+                return function(request, *args, **kws)
+            finally:
+                limiter.release()
+        _wrapper.limit_stats = stats
+        return _wrapper
+    return _decorator
+
+class _Limiter(object):
+    """
+    A counting semaphore with a bounded, timed wait.
+    """
+    # Returned from acquire, when the caller had to wait.
+    QUEUED = 2
+
+    def __init__(self, limit, max_queue=None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.condition = threading.Condition(threading.Lock())
+        self.in_flight = 0
+        self.waiting = 0
+
+    def acquire(self, timeout=0):
+        """
+        Takes a slot if one is free, or waits up to timeout seconds for
+        one. Returns True (or QUEUED if it had to wait), or False if no
+        slot was taken.
+        """
+        with self.condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            if not timeout or (self.max_queue is not None and
+                               self.waiting >= self.max_queue):
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.time() + timeout
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                return _Limiter.QUEUED
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        """
+        Frees a slot, and wakes up a waiting caller, if there is one.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+# The values the response decorator options can take (besides None),
+# as types, 'callable' for a function, or particular values. Options
+# not listed here can take any value.
+_OPTION_VALUES = dict(
+    stream=(bool,), negotiate=(bool,), gzip=(bool,),
+    project=(dict,), fragments=(dict,),
+    etag=(bool, 'callable'), timing=(bool, 'callable'),
+    coalesce=(bool, 'callable', 'user'), cache_key=('callable',),
+    cache_seconds=(int, long, float), gzip_threshold=(int, long),
+    html_max_items=(int, long), html_max_depth=(int, long)
+    )
+
+def _pop_options(other_data, **defaults):
+    """
+    Removes the decorator options with the given names from the
+    keyword arguments of a response decorator (the rest of which are
+    static data), and returns a dictionary of their values. Static
+    data with the same name as an option can be given in a
+    'static_data' dictionary instead. An option with a value it can't
+    take is most likely meant as static data, so raises TypeError.
+    """
+    options = dict()
+    for name, default in defaults.items():
+        value = options[name] = other_data.pop(name, default)
+        if value is not None and not _valid_option(name, value):
+            raise TypeError(
+                "%r isn't a valid value for the '%s' option. To add "
+                "static data called '%s', pass it in static_data." % (
+                    value, name, name
+                    )
+                )
+    other_data.update(other_data.pop('static_data', None) or {})
+    return options
+
+def _valid_option(name, value):
+    """
+    Returns True if the named response decorator option can take the
+    given (not None) value.
+    """
+    allowed = _OPTION_VALUES.get(name)
+    if allowed is None:
+        return True
+    for kind in allowed:
+        if kind == 'callable':
+            if callable(value):
+                return True
+        elif isinstance(kind, type):
+            if isinstance(value, kind):
+                return True
+        elif value == kind:
+            return True
+    return False
+
 # Response types
 def json_response(**other_data):
     """
     A parameterized decorator that returns a response in json format.
+
+    Keyword arguments are added to the result as static data, except
+    for the following options (static data with one of these names can
+    be given in a 'static_data' dictionary instead):
+
+    * 'stream' - if True, the json is encoded incrementally as the
+      response is sent, so the result can contain generators and
+      querysets, e.g. dict(photos=Photo.objects.all()), and the whole
+      result is never held in memory. Querysets are iterated with
+      iterator(). The 'format=html' debug output isn't streamed.
+
+    * 'project' - a dictionary mapping keys in the result to a sequence
+      of field names, e.g. dict(photos=('id', 'title', 'owner__name')).
+      If the view returns a queryset (or manager) under one of those
+      keys, only those fields are fetched from the database (with
+      values_list), and each row is encoded as a json object straight
+      from the tuple of values, without creating model instances.
+
+    * 'etag' - if True, successful responses get an ETag that is a
+      digest of their content, and a GET with a matching
+      If-None-Match header gets a 304 response instead. It can also be
+      a function taking the same arguments as the view, that returns a
+      version key for the response (or None if it can't tell). In that
+      case the 304 is returned without calling the view at all. Only
+      version keys give streamed responses an ETag.
+
+    * 'cache_seconds' - if given, the encoded content of successful GET
+      responses is cached for this many seconds, and used instead of
+      calling the view. By default the cache key is the full path,
+      including the query string.
+
+    * 'cache_key' - a function taking the same arguments as the view,
+      that returns the key to cache the response under, or None if it
+      shouldn't be cached. The format and callback parameters are
+      always added to the key. Given without 'cache_seconds', this
+      also turns the cache on, with the backend's default timeout.
+
+    * 'cache' - the cache backend to use, either a backend instance or
+      a name or URI for django.core.cache.get_cache. By default this
+      is a local-memory cache. It is an error to give this without
+      'cache_seconds' or 'cache_key'.
+
+    * 'gzip' - if True, the response is gzip compressed when the
+      client accepts it, and the content is at least 'gzip_threshold'
+      bytes long (1024 by default). Streamed responses are compressed
+      as they are sent, once the threshold is reached.
+
+    * 'timing' - if True, the response gets a Server-Timing header
+      with the time spent in the view, encoding the json ('serialize'),
+      computing the ETag, compressing it and in total, along with the
+      database time and number of queries when django is recording
+      them (i.e. in debug mode). A streamed response is encoded (and
+      any lazy querysets in it run) after the view returns, so it has
+      no 'serialize' or database figures. It can also be a function,
+      which is called as timing(request, view, timings) with a
+      dictionary of the same figures in seconds, so they can be sent
+      to a metrics system.
+
+    * 'coalesce' - if True, concurrent GET requests for the same path
+      and query string share a single call to the view: the first one
+      runs it, and the others wait and get a copy of its response. Set
+      it to 'user' to only share between requests from the same user,
+      or to a function taking the same arguments as the view, that
+      returns the key to share on (or None not to share). The copies
+      include any cookies the view set, so use 'user' or a key
+      function for views that set cookies for a particular client. If
+      the view raises an exception, the waiting requests raise it too.
+      Streamed responses can't be shared, so each waiting request then
+      runs the view itself.
+
+    * 'negotiate' - if True, the Accept header can ask for any of the
+      encodings registered in dj_utils.encoders, instead of json (e.g.
+      application/cbor, or application/msgpack if msgpack is
+      installed). The result is the same, including 'ok', and the
+      status works the same way. The format=html and callback
+      parameters still give html and jsonp.
+
+    * 'html_max_items' and 'html_max_depth' - limits for the
+      format=html debug output. Arrays and objects show their first
+      'html_max_items' items (1000 by default), and are collapsed to a
+      count of their items below 'html_max_depth' levels of nesting
+      (32 by default). Either can be None for no limit.
+
+    The cache hit and miss counts are available as the 'cache_stats'
+    attribute of the decorated view. Streamed responses aren't cached.
     """
+    options = _pop_options(
+        other_data, stream=False, project=None, etag=False,
+        cache_seconds=None, cache_key=None, cache=None,
+        gzip=False, gzip_threshold=1024, timing=False, coalesce=False,
+        negotiate=False, html_max_items=1000, html_max_depth=32
+        )
+
+    _check_cache_options(options)
+
     def _decorator(function):
+        cache = _ResponseCache.from_options(function, options)
+        flights = _SingleFlight() if options['coalesce'] else None
+        html = _JSONToHTML(
+            options['html_max_items'], options['html_max_depth']
+            )
+
         @functools.wraps(function)
         def _wrapper(request, *args, **kws):
-            result = function(request, *args, **kws)
+            timing = _Timing() if options['timing'] else None
+            encoding = None
+            if options['negotiate']:
+                encoding = _negotiate_encoding(request)
+            content_type = encoding and encoding.content_type
 
-            # If we get a valid response, then return it unchanged.
-            if isinstance(result, http.HttpResponse): return result
+            # Check the version key before doing any work.
+            etag = _version_etag(
+                options['etag'], request, args, kws,
+                request.GET.get('format'), request.GET.get('callback'),
+                content_type
+                )
+            if etag is not None and _etag_matches(request, etag):
+                return _not_modified(etag)
 
-            # Add success code.
-            if result is None: result = dict()
-            if 'ok' not in result: result['ok'] = True
+            # Check for a cached response.
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key(request, args, kws, content_type)
+                response = cache.get(cache_key)
+                if response is not None:
+                    if timing: timing.lap('cache')
+                    return _finish(request, response, etag, timing)
 
-            # Find the status code.
-            status = result.get('status')
-            if status:
-                del result['status']
+            if flights is None:
+                response, passthrough = _compute(
+                    request, args, kws, encoding, cache_key, timing
+                    )
+            else:
+                # Let one request for this key compute the response,
+                # and give any others a copy of it.
+                key = _coalesce_key(options['coalesce'], request, args, kws)
+                if key is not None and content_type:
+                    key = (key, content_type)
+                response, passthrough, leader = flights.run(
+                    key, _compute,
+                    request, args, kws, encoding, cache_key, timing
+                    )
+                if timing and not leader: timing.lap('coalesced')
 
-            # Add static data.
-            result.update(other_data)
+            # If we get a valid response, then return it unchanged.
+            if passthrough: return response
+            return _finish(request, response, etag, timing)
 
-            # Output the correct format.
-            if request.GET.get('format') == 'html':
-                # Output as debug HTML
-                response = http.HttpResponse(
-                    content_type="text/html",
-                    status=status
+        def _compute(request, args, kws, encoding, cache_key, timing):
+            # Returns the response, and whether it came from the view.
+            result = function(request, *args, **kws)
+            if timing: timing.lap('view')
+            if isinstance(result, http.HttpResponse): return result, True
+
+            response = _json_result_response(
+                request, result, other_data,
+                options['stream'], options['project'], encoding, html
+                )
+            if cache_key is not None:
+                cache.set(cache_key, response)
+            if timing: timing.lap('serialize')
+            return response, False
+
+        def _finish(request, response, etag, timing):
+            # Apply the options that post-process the encoded response.
+            if options['negotiate']:
+                patch_vary_headers(response, ('Accept',))
+            if options['etag']:
+                response = _conditional_response(request, response, etag)
+                if timing: timing.lap('etag')
+            if options['gzip']:
+                response = _gzip_response(
+                    request, response, options['gzip_threshold']
                     )
-                response.write(_JSONToHTML.before % request.path)
-                _JSONToHTML._output(response, result)
-                response.write(_JSONToHTML.after)
-                return response
-            else:
-                json_string = json.dumps(result)
-                callback = request.GET.get("callback")
-                if callback is None:
-                    # We have a vanilla JSON request
-                    return http.HttpResponse(
-                        json_string,
-                        content_type="application/json",
-                        status=status
-                        )
-                else:
-                    # We have a JSONP request
-                    return http.HttpResponse(
-                        "%s(%s);" % (callback, json_string),
-                        content_type="application/javascript",
-                        status=status
-                        )
+                if timing: timing.lap('compress')
+            if timing:
+                timing.finish(request, response, function, options['timing'])
+            return response
+
+        if cache is not None:
+            _wrapper.cache_stats = cache.stats
         return _wrapper
     return _decorator
 
-class _JSONToHTML(object):
+def _json_result_response(request, result, other_data, stream=False,
+                          project=None, encoding=None, html=None):
     """
-    This class is just used to hide its methods.
+    Returns the response for the result dictionary returned by a
+    json_response view. If an encoding from dj_utils.encoders is given,
+    it is used instead of json, and if a _JSONToHTML renderer is given,
+    it renders the format=html output.
     """
-    @staticmethod
-    def _output(response, data):
-        if isinstance(data, list):
-            _JSONToHTML._output_array(response, data)
-        elif isinstance(data, dict):
-            _JSONToHTML._output_object(response, data)
-        elif data in (True, False):
-            _JSONToHTML._output_boolean(response, data)
-        elif isinstance(data, basestring):
-            _JSONToHTML._output_string(response, data)
-        elif data is None:
-            _JSONToHTML._output_null(response, data)
+    # Add success code.
+    if result is None: result = dict()
+    if 'ok' not in result: result['ok'] = True
+
+    # Apply any projections.
+    if project:
+        for key, fields in project.items():
+            if key in result:
+                result[key] = _project(result[key], fields)
+
+    # Find the status code.
+    status = result.get('status')
+    if status:
+        del result['status']
+
+    # Add static data.
+    result.update(other_data)
+
+    # Output the correct format.
+    if request.GET.get('format') == 'html':
+        # Output as debug HTML. The result may hold generators and
+        # querysets, so it is normalised to what the json would hold.
+        result = json.loads(encoders.encode(result))
+        return http.HttpResponse(
+            (html or _JSONToHTML()).render(request.path, result),
+            content_type="text/html",
+            status=status
+            )
+    elif encoding is not None:
+        # Output in the negotiated encoding.
+        if stream and encoding.iterencode is not None:
+            return StreamingHttpResponse(
+                encoding.iterencode(result),
+                content_type=encoding.content_type,
+                status=status
+                )
+        return http.HttpResponse(
+            encoding.encode(result),
+            content_type=encoding.content_type,
+            status=status
+            )
+    elif stream:
+        content = encoders.iterencode(result)
+        callback = request.GET.get("callback")
+        if callback is None:
+            return StreamingHttpResponse(
+                content,
+                content_type="application/json",
+                status=status
+                )
+        else:
+            return StreamingHttpResponse(
+                itertools.chain(["%s(" % callback], content, [");"]),
+                content_type="application/javascript",
+                status=status
+                )
+    else:
+        json_string = encoders.encode(result)
+        callback = request.GET.get("callback")
+        if callback is None:
+            # We have a vanilla JSON request
+            return http.HttpResponse(
+                json_string,
+                content_type="application/json",
+                status=status
+                )
         else:
-            _JSONToHTML._output_number(response, data)
+            # We have a JSONP request
+            return http.HttpResponse(
+                "%s(%s);" % (callback, json_string),
+                content_type="application/javascript",
+                status=status
+                )
 
-    @staticmethod
-    def _output_boolean(response, boolean):
-        response.write("<div class='boolean'>%s</div>" % str(boolean).lower())
+def _negotiate_encoding(request):
+    """
+    Returns the encoding the request's Accept header asks for, or None
+    if the response should be json or one of the json variants.
+    """
+    if request.GET.get('format') == 'html' or 'callback' in request.GET:
+        return None
+    encoding = encoders.negotiate(request.META.get('HTTP_ACCEPT'))
+    if encoding is encoders.JSON:
+        return None
+    return encoding
 
-    @staticmethod
-    def _output_string(response, literal):
-        response.write(
-            "<div class='string'>\"%s\"</div>" % cgi.escape(literal)
+def _project(value, fields):
+    """
+    Returns the projection of a queryset or manager onto the given
+    fields, or the value unchanged if it is neither.
+    """
+    if hasattr(value, 'get_query_set'):
+        value = value.all()
+    if hasattr(value, 'values_list') and hasattr(value, 'model'):
+        return encoders.ProjectedRows(value, fields)
+    return value
+
+# Conditional GET support.
+def _version_etag(etag_option, request, args, kws, *variant):
+    """
+    Returns the ETag for the version key given by the view's etag
+    function, if it has one. The variant is any other request data
+    that changes the content for the same version (e.g. the json
+    format).
+    """
+    if not callable(etag_option):
+        return None
+    key = etag_option(request, *args, **kws)
+    if key is None:
+        return None
+    digest = hashlib.md5(smart_str(key))
+    for part in variant:
+        digest.update('\0' + smart_str(part or ''))
+    return '"%s"' % digest.hexdigest()
+
+def _etag_matches(request, etag):
+    """
+    Returns True if the request is a GET (or HEAD) with an
+    If-None-Match header matching the given ETag.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+def _not_modified(etag):
+    """
+    Returns a 304 response for the given ETag.
+    """
+    response = http.HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+def _conditional_response(request, response, etag=None):
+    """
+    Adds an ETag to a successful response, calculating it from the
+    content if no version ETag is given. Returns a 304 response instead
+    if the request already has that ETag.
+    """
+    if response.status_code != 200:
+        return response
+    if etag is None:
+        if _is_streaming(response):
+            # We can't digest streamed content without consuming it.
+            return response
+        etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    response['ETag'] = etag
+    return response
+
+# Timing.
+class _Timing(object):
+    """
+    Records how long each phase of handling a request takes, for the
+    timing option of the response decorators.
+    """
+    def __init__(self):
+        self.start = self.mark = time.time()
+        self.durations = []
+        self.query_counts = _query_counts()
+
+    def lap(self, name):
+        """
+        Records the time since the last lap as the given phase.
+        """
+        now = time.time()
+        self.durations.append((name, now - self.mark))
+        self.mark = now
+
+    def finish(self, request, response, function, collector):
+        """
+        Adds the Server-Timing header to the response, and passes the
+        timings to the collector, if it is a function. A streamed
+        response is encoded, and its queries run, after the header is
+        sent, so the 'serialize' and database figures are left out.
+        """
+        durations = self.durations
+        streamed = _is_streaming(response)
+        if streamed:
+            durations = [
+                (name, duration) for name, duration in durations
+                if name != 'serialize'
+                ]
+        timings = dict(durations)
+        timings['total'] = time.time() - self.start
+        parts = [
+            '%s;dur=%.1f' % (name, duration * 1000)
+            for name, duration in durations
+            ]
+        queries = None if streamed else _query_stats(self.query_counts)
+        if queries is not None:
+            timings['queries'], timings['db'] = queries
+            parts.append('db;dur=%.1f;desc="%d queries"' % (
+                queries[1] * 1000, queries[0]
+                ))
+        parts.append('total;dur=%.1f' % (timings['total'] * 1000))
+        response['Server-Timing'] = ', '.join(parts)
+        if callable(collector):
+            collector(request, function, timings)
+
+def _query_counts():
+    """
+    Returns the number of queries each database connection has
+    recorded so far, or None if none of them are recording queries.
+    """
+    from django.conf import settings
+    from django.db import connections
+    counts = dict()
+    for connection in connections.all():
+        if connection.use_debug_cursor or \
+                (connection.use_debug_cursor is None and settings.DEBUG):
+            counts[connection.alias] = len(connection.queries)
+    return counts or None
+
+def _query_stats(counts):
+    """
+    Returns a tuple of the number of queries and the seconds they took
+    since the given query counts were taken, or None if queries aren't
+    being recorded.
+    """
+    if counts is None:
+        return None
+    from django.db import connections
+    number = 0
+    seconds = 0.0
+    for alias, count in counts.items():
+        queries = connections[alias].queries[count:]
+        number += len(queries)
+        seconds += sum(float(query['time']) for query in queries)
+    return number, seconds
+
+# Compression.
+_accepts_gzip_re = re.compile(r'\bgzip\b')
+
+def _gzip_response(request, response, threshold):
+    """
+    Returns the response with its content gzip compressed, if the
+    client accepts that and the content is at least threshold bytes.
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if response.status_code in (204, 304) or \
+            response.has_header('Content-Encoding'):
+        return response
+    accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not _accepts_gzip_re.search(accept):
+        return response
+
+    if _is_streaming(response):
+        # The headers go before the content, so we need to decide now.
+        # Read ahead until we reach the threshold, or run out.
+        chunks = iter(_get_streaming_content(response))
+        head = []
+        size = 0
+        for chunk in chunks:
+            chunk = smart_str(chunk)
+            head.append(chunk)
+            size += len(chunk)
+            if size >= threshold:
+                break
+        else:
+            _set_streaming_content(response, head)
+            return response
+        del response['Content-Length']
+        _set_streaming_content(
+            response, _gzip_chunks(itertools.chain(head, chunks))
             )
+    else:
+        if len(response.content) < threshold:
+            return response
+        content = compress_string(response.content)
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
 
-    @staticmethod
-    def _output_number(response, literal):
-        response.write("<div class='number'>%s</div>" % str(literal))
+    # The compressed content is a different representation, so it can
+    # only have a weak ETag (which still works for If-None-Match).
+    if response.has_header('ETag') and \
+            not response['ETag'].startswith('W/'):
+        response['ETag'] = 'W/' + response['ETag']
+    response['Content-Encoding'] = 'gzip'
+    return response
 
-    @staticmethod
-    def _output_null(response, literal):
-        response.write("<div class='null'>null</div>")
+def _gzip_chunks(chunks):
+    """
+    Yields the gzip compressed version of the given chunks of content.
+    Each chunk is flushed, so the client can use it straight away.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(smart_str(chunk))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
 
-    @staticmethod
-    def _output_object(response, obj):
-        response.write("<div class='object'>")
-        count = len(obj)
-        if count:
-            response.write("<table>")
-            for key, value in sorted(obj.items()):
-                response.write("<tr><th>%s:</th><td>" % cgi.escape(key))
-                _JSONToHTML._output(response, value)
-                response.write("</td></tr>")
-            response.write("</table>")
+def _get_streaming_content(response):
+    """
+    Returns the iterator of a streamed response's content.
+    """
+    if hasattr(response, 'streaming_content'):
+        return response.streaming_content
+    return response._container
+
+def _set_streaming_content(response, content):
+    """
+    Sets the iterator of a streamed response's content.
+    """
+    if hasattr(response, 'streaming_content'):
+        response.streaming_content = content
+    else:
+        response.content = content
+
+# Request coalescing.
+def _coalesce_key(coalesce, request, args, kws):
+    """
+    Returns the key that identifies identical requests for the given
+    coalesce option, or None if the request shouldn't be coalesced.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if callable(coalesce):
+        return coalesce(request, *args, **kws)
+    key = (request.method, request.get_full_path())
+    if coalesce == 'user':
+        user = getattr(request, 'user', None)
+        key += (getattr(user, 'pk', None),)
+    return key
+
+class _Flight(object):
+    """
+    A computation in progress for _SingleFlight.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.snapshot = None
+        self.exc_info = None
+
+class _SingleFlight(object):
+    """
+    Runs a function that computes a response, making sure that only
+    one thread at a time does so for any given key. Other threads with
+    the same key wait, and get a copy of the response, or the exception
+    it raised.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = dict()
+
+    def run(self, key, function, *args):
+        """
+        Returns the (response, passthrough) pair returned by the
+        function, and whether this thread was the one to call it.
+        """
+        if key is None:
+            return function(*args) + (True,)
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if leader:
+            try:
+                response, passthrough = function(*args)
+                if not _is_streaming(response):
+                    # Copy it before the caller changes it.
+                    flight.snapshot = _copy_response(response), passthrough
+                return response, passthrough, True
+            except:
+                flight.exc_info = sys.exc_info()
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+
+        flight.done.wait()
+        if flight.exc_info is not None:
+            exc_type, exc_value, exc_traceback = flight.exc_info
+            raise exc_type, exc_value, exc_traceback
+        if flight.snapshot is None:
+            # The leader streamed, so we're on our own.
+            return function(*args) + (False,)
+        response, passthrough = flight.snapshot
+        return _copy_response(response), passthrough, False
+
+def _copy_response(response):
+    """
+    Returns a copy of a response that isn't streamed, with its own
+    content, headers and cookies, so it can be changed independently.
+    """
+    clone = copy.copy(response)
+    clone._headers = dict(response._headers)
+    clone.cookies = copy.deepcopy(response.cookies)
+    clone.content = response.content
+    return clone
+
+class Counters(object):
+    """
+    A thread-safe set of named counters, used by decorators to expose
+    statistics about the views they wrap.
+    """
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def as_dict(self):
+        """
+        Returns a copy of the current counts.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        """
+        Sets all the counts back to zero.
+        """
+        with self._lock:
+            for name in self._counts:
+                self._counts[name] = 0
+
+def _check_cache_options(options):
+    """
+    Raises TypeError if a cache backend is given to a response
+    decorator without the options that turn caching on.
+    """
+    if options['cache'] is not None and not options['cache_seconds'] \
+            and options['cache_key'] is None:
+        raise TypeError(
+            "The 'cache' option needs 'cache_seconds' or 'cache_key'."
+            )
+
+class _ResponseCache(object):
+    """
+    Caches the content of a view's responses, for the json_response
+    and template_response decorators (given as 'kind').
+    """
+    # The cache used when none is specified, created on first use.
+    default_cache = None
+
+    def __init__(self, function, seconds, key_function=None, cache=None,
+                 kind='json_response'):
+        self.seconds = seconds
+        self.key_function = key_function
+        self.cache = cache
+        self.prefix = 'dj_utils.%s:%s.%s:' % (
+            kind, function.__module__, function.__name__
+            )
+        self.stats = Counters('hits', 'misses')
+
+    @classmethod
+    def from_options(cls, function, options, kind='json_response'):
+        """
+        Returns the cache for a view with the given decorator options,
+        or None if they don't turn caching on.
+        """
+        if not options['cache_seconds'] and options['cache_key'] is None:
+            return None
+        return cls(
+            function, options['cache_seconds'], options['cache_key'],
+            options['cache'], kind
+            )
+
+    def get_backend(self):
+        """
+        Returns the cache backend, loading it if necessary.
+        """
+        from django.core.cache import get_cache
+        if self.cache is None:
+            if _ResponseCache.default_cache is None:
+                _ResponseCache.default_cache = get_cache(
+                    'django.core.cache.backends.locmem.LocMemCache',
+                    LOCATION='dj_utils.json_response'
+                    )
+            self.cache = _ResponseCache.default_cache
+        elif isinstance(self.cache, basestring):
+            self.cache = get_cache(self.cache)
+        return self.cache
+
+    def key(self, request, args, kws, variant=None):
+        """
+        Returns the cache key for the given request, or None if its
+        response shouldn't be cached. The variant is any other data
+        that changes the content (i.e. a negotiated content type).
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if self.key_function is None:
+            key = request.get_full_path()
         else:
-            response.write("{}")
+            key = self.key_function(request, *args, **kws)
+            if key is None:
+                return None
+            key = '%s\0%s\0%s' % (
+                smart_str(key),
+                smart_str(request.GET.get('format', '')),
+                smart_str(request.GET.get('callback', ''))
+                )
+        if variant:
+            key = '%s\0%s' % (key, smart_str(variant))
+        # Hash the key so that it is safe for any backend.
+        return self.prefix + hashlib.md5(smart_str(key)).hexdigest()
 
-        response.write("</div>")
+    def get(self, key):
+        """
+        Returns a new response from the cached content for the given
+        key, or None if there isn't any.
+        """
+        if key is None:
+            return None
+        cached = self.get_backend().get(key)
+        if cached is None:
+            self.stats.increment('misses')
+            return None
+        self.stats.increment('hits')
+        status, content_type, content = cached
+        return http.HttpResponse(
+            content, content_type=content_type, status=status
+            )
+
+    def set(self, key, response):
+        """
+        Caches the content of the given response, if it was successful.
+        """
+        if response.status_code != 200 or _is_streaming(response):
+            return
+        self.get_backend().set(
+            key,
+            (response.status_code, response['Content-Type'], response.content),
+            self.seconds
+            )
+
+class _JSONToHTML(object):
+    """
+    Renders a result as nested html tables, for the format=html debug
+    output of json_response. The result is walked with a stack, rather
+    than recursively, so deep results are fine, and arrays and objects
+    are cut short after 'max_items' items, and collapsed altogether
+    below 'max_depth' levels (either can be None for no limit).
+    """
+    def __init__(self, max_items=None, max_depth=None):
+        self.max_items = max_items
+        self.max_depth = max_depth
+
+    def render(self, path, data):
+        """
+        Returns the html page for the given data.
+        """
+        parts = [self.before % cgi.escape(force_unicode(path))]
+        append = parts.append
+        scalar = self._scalar
+        max_items = self.max_items
+        max_depth = self.max_depth
+        labels = {}
+
+        # The stack holds (html, None) for html to output as it is, and
+        # (value, depth) for arrays and objects still to be rendered.
+        stack = [(data, 0)]
+        pop = stack.pop
+        while stack:
+            value, depth = pop()
+            if depth is None:
+                append(value)
+                continue
+            html = scalar(value)
+            if html is not None:
+                append(html)
+                continue
+
+            if isinstance(value, dict):
+                kind, empty, noun = 'object', '{}', 'keys'
+                items = []
+                for key in sorted(value)[:max_items]:
+                    label = labels.get(key)
+                    if label is None:
+                        label = labels[key] = \
+                            cgi.escape(force_unicode(key)) + u':'
+                    items.append((label, value[key]))
+            else:
+                kind, empty, noun = 'array', '[]', 'items'
+                items = [
+                    ('%d' % index, item)
+                    for index, item in enumerate(value[:max_items])
+                    ]
+            if not value:
+                append("<div class='%s'>%s</div>" % (kind, empty))
+                continue
+            if max_depth is not None and depth >= max_depth:
+                append("<div class='%s'><p>%d %s</p></div>" % (
+                    kind, len(value), noun
+                    ))
+                continue
+
+            # Rows of scalars are output in one go, and the rest are
+            # pushed on the stack (in reverse, so they come off in
+            # order), with the html between them joined up.
+            pending = []
+            html = ["<div class='%s'><table>" % kind]
+            for label, item in items:
+                item_html = scalar(item)
+                if item_html is not None:
+                    html.append(
+                        "<tr><th>%s</th><td>%s</td></tr>" % (label, item_html)
+                        )
+                else:
+                    html.append("<tr><th>%s</th><td>" % label)
+                    pending.append((''.join(html), None))
+                    pending.append((item, depth + 1))
+                    html = ["</td></tr>"]
+            if len(value) > len(items):
+                html.append(
+                    "<tr><th>...</th><td><p>%d more %s</p></td></tr>" % (
+                        len(value) - len(items), noun
+                        )
+                    )
+            html.append("</table></div>")
+            pending.append((''.join(html), None))
+            pending.reverse()
+            stack.extend(pending)
+        append(self.after)
+        return u''.join(parts)
 
     @staticmethod
-    def _output_array(response, seq):
-        response.write("<div class='array'>")
-        count = len(seq)
-        if count:
-            response.write("<table>")
-            for i, item in enumerate(seq):
-                response.write("<tr><th>%d</th><td>" % i)
-                _JSONToHTML._output(response, item)
-                response.write("</td></tr>")
-            response.write("</table>")
-        else:
-            response.write("[]")
-        response.write("</div>")
+    def _scalar(value):
+        """
+        Returns the html for a value that isn't an array or object, or
+        None if it is one. Byte strings are taken to be UTF-8.
+        """
+        if isinstance(value, basestring):
+            return u"<div class='string'>\"%s\"</div>" % cgi.escape(
+                force_unicode(value)
+                )
+        elif isinstance(value, bool):
+            return "<div class='boolean'>%s</div>" % str(value).lower()
+        elif value is None:
+            return "<div class='null'>null</div>"
+        elif isinstance(value, (list, tuple, dict)):
+            return None
+        return u"<div class='number'>%s</div>" % force_unicode(value)
 
     before = """<!DOCTYPE HTML><html><head><style>
 body { line-height: 16px; font-size: 14px; font-family: sans; }
@@ -178,26 +1102,157 @@ def template_response(templ, **other_data):
     """
     A parameterized decorator that returns a response passed through a
     template.
+
+    Keyword arguments are added to the context as static data, except
+    for the options below, and 'static_data', a dictionary of static
+    data whose names clash with them. The 'etag' and 'timing' options
+    work as they do for json_response (with the template time given
+    as 'render'). A
+    version key should take account of anything the page depends on,
+    including the user and any context processors. As well as these:
+
+    * 'cache_key' - a function taking the same arguments as the view,
+      that returns a key for the rendered page (or None if it shouldn't
+      be cached), such as the id and modification time of the object
+      it shows. As for json_response, either this or 'cache_seconds'
+      turns the cache on, and without this the key is the full path
+      (so only use 'cache_seconds' alone for pages that are the same
+      for every user). A cached page is returned before the view or any
+      context processors run, so the key has to account for anything
+      the page depends on, apart from its fragments. A page that uses
+      the CSRF token (e.g. with {% csrf_token %}) is never cached,
+      since the token is different for each client: put the token in a
+      fragment instead, with csrf_fragment.
+
+    * 'cache_seconds' and 'cache' - how long to cache the page for,
+      and the cache backend to use, as for json_response. The default
+      timeout is the backend's.
+
+    * 'fragments' - a dictionary mapping names to functions taking the
+      same arguments as the view, that return the html for parts of
+      the page that differ between requests, such as the user's name.
+      The template includes them as {{ cache_fragments.name }}, and
+      they are filled in for each request, whether or not the rest of
+      the page came from the cache.
     """
+    options = _pop_options(
+        other_data, etag=False, timing=False,
+        cache_key=None, cache_seconds=None, cache=None, fragments=None
+        )
+    fragments = options['fragments'] or {}
+    _check_cache_options(options)
+
     def _decorator(function):
+        cache = _ResponseCache.from_options(
+            function, options, 'template_response'
+            )
+
         @functools.wraps(function)
         def _wrapper(request, *args, **kws):
+            timing = _Timing() if options['timing'] else None
+
+            # Check the version key before doing any work.
+            etag = _version_etag(options['etag'], request, args, kws)
+            if etag is not None and _etag_matches(request, etag):
+                return _not_modified(etag)
+
+            # Check for a cached page, before the context is built.
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key(request, args, kws)
+                response = cache.get(cache_key)
+                if response is not None:
+                    if timing: timing.lap('cache')
+                    return _finish(request, args, kws, response, etag, timing)
+
             result = function(request, *args, **kws)
+            if timing: timing.lap('view')
 
             # If we get a valid response, then return it unchanged.
             if isinstance(result, http.HttpResponse): return result
 
             # Add static data.
             result.update(other_data)
+            if fragments:
+                result['cache_fragments'] = dict(
+                    (name, _fragment_marker(name)) for name in fragments
+                    )
 
             # Render to a template and return.
-            return shortcuts.render_to_response(
+            response = shortcuts.render_to_response(
                 templ, result,
                 context_instance=template.RequestContext(request)
                 )
+            if timing: timing.lap('render')
+            if cache_key is not None and \
+                    not request.META.get('CSRF_COOKIE_USED'):
+                cache.set(cache_key, response)
+            return _finish(request, args, kws, response, etag, timing)
+
+        def _finish(request, args, kws, response, etag, timing):
+            # Fill in the fragments and apply the other options.
+            if fragments:
+                response.content = _fill_fragments(
+                    response.content, fragments, request, args, kws
+                    )
+                if timing: timing.lap('fragments')
+            if options['etag']:
+                response = _conditional_response(request, response, etag)
+                if timing: timing.lap('etag')
+            if timing:
+                timing.finish(request, response, function, options['timing'])
+            return response
+
+        if cache is not None:
+            _wrapper.cache_stats = cache.stats
         return _wrapper
     return _decorator
 
+def csrf_fragment(request, *args, **kws):
+    """
+    A template_response fragment that gives the hidden input for the
+    CSRF token, as {% csrf_token %} does, for pages that are cached.
+    """
+    from django.middleware.csrf import get_token
+    token = get_token(request)
+    if token is None:
+        return u''
+    return mark_safe(
+        u"<div style='display:none'><input type='hidden' "
+        u"name='csrfmiddlewaretoken' value='%s' /></div>" % cgi.escape(token)
+        )
+
+def _fragment_marker(name):
+    """
+    Returns the placeholder rendered in a template_response page for
+    the named fragment. It includes a token derived from the
+    SECRET_KEY, so that it can't be forged by content in the page, but
+    is the same in every process sharing the cache.
+    """
+    global _fragment_token
+    if _fragment_token is None:
+        from django.conf import settings
+        _fragment_token = hashlib.md5(
+            'dj_utils.fragment:' + smart_str(settings.SECRET_KEY)
+            ).hexdigest()
+    return mark_safe(
+        '<!--dj_utils.fragment:%s:%s-->' % (_fragment_token, name)
+        )
+_fragment_token = None
+
+def _fill_fragments(content, fragments, request, args, kws):
+    """
+    Returns the content of a page with the placeholders for the given
+    fragments replaced by their html for this request.
+    """
+    for name, fragment in fragments.iteritems():
+        marker = smart_str(_fragment_marker(name))
+        if marker in content:
+            content = content.replace(
+                marker, smart_str(fragment(request, *args, **kws))
+                )
+    return content
+
 
 def report_errors(fn):
     """
@@ -217,3 +1272,152 @@ def report_errors(fn):
             traceback.print_exc(file=sys.stderr)
     return _wrapper
 
+# The salt for the signed values that request a profile.
+_PROFILE_SALT = 'dj_utils.decorators.profile_view'
+
+def profile_request_token():
+    """
+    Returns a signed value that, sent in an X-Profile header, makes a
+    view decorated with profile_view profile that request. The value
+    is signed with the SECRET_KEY, and expires after an hour.
+    """
+    from django.core import signing
+    return signing.dumps(int(time.time()), salt=_PROFILE_SALT)
+
+def profile_view(sample=1000, directory=None, keep=100, max_age=3600):
+    """
+    A parameterized decorator that profiles one in every 'sample'
+    requests with cProfile (set sample to None to disable sampling), as
+    well as any request with a valid X-Profile header (see
+    profile_request_token), that is no older than 'max_age' seconds.
+
+    The stats of each profiled request are written to a .pstats file
+    in 'directory' (by default a dj_utils_profiles directory in the
+    system's temp directory), whose name gives the view, the time it
+    took in milliseconds, and when it ran. Only the newest 'keep' files
+    are kept. Use aggregate_profiles to combine them.
+
+    Unlike report_errors, this is intended to be left on in
+    production: requests that aren't profiled only pay for a random
+    number, and a profile that can't be saved is logged, rather than
+    failing the request.
+    """
+    if directory is None:
+        directory = _default_profile_directory()
+
+    def _decorator(function):
+        view_name = '%s.%s' % (function.__module__, function.__name__)
+
+        @functools.wraps(function)
+        def _wrapper(request, *args, **kws):
+            if not _should_profile(request, sample, max_age):
+                return function(request, *args, **kws)
+
+            profiler = cProfile.Profile()
+            start = time.time()
+            try:
+                return profiler.runcall(function, request, *args, **kws)
+            finally:
+                duration = time.time() - start
+                try:
+                    _save_profile(
+                        profiler, directory, view_name, duration, keep
+                        )
+                except (EnvironmentError, ValueError, TypeError):
+                    logger.exception(
+                        "Can't save profile of '%s' in '%s'",
+                        view_name, directory
+                        )
+        return _wrapper
+    return _decorator
+
+def _default_profile_directory():
+    return os.path.join(tempfile.gettempdir(), 'dj_utils_profiles')
+
+def _should_profile(request, sample, max_age):
+    """
+    Returns True if the given request should be profiled.
+    """
+    if sample and random.random() * sample < 1.0:
+        return True
+    token = request.META.get('HTTP_X_PROFILE')
+    if token:
+        from django.core import signing
+        try:
+            signing.loads(token, salt=_PROFILE_SALT, max_age=max_age)
+        except signing.BadSignature:
+            return False
+        return True
+    return False
+
+def _save_profile(profiler, directory, view_name, duration, keep):
+    """
+    Writes the profiler's stats into the directory, and removes the
+    oldest files in it, so no more than 'keep' remain.
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have just created it.
+            if not os.path.isdir(directory):
+                raise
+    now = time.time()
+    filename = '%s-%dms-%s%06d-%d.pstats' % (
+        view_name, duration * 1000,
+        time.strftime('%Y%m%d%H%M%S', time.localtime(now)),
+        (now % 1) * 1000000, os.getpid()
+        )
+    # Write to a temporary file first, so readers never see half a file.
+    path = os.path.join(directory, filename)
+    profiler.dump_stats(path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+    paths = [
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith('.pstats')
+        ]
+    if len(paths) > keep:
+        paths.sort(key=_mtime_or_zero)
+        for old_path in paths[:-keep]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+def _mtime_or_zero(path):
+    """
+    Returns the modification time of the path, or zero if it has gone.
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+def aggregate_profiles(directory=None, view_name=None):
+    """
+    Returns a pstats.Stats object combining all the profiles saved by
+    profile_view in the given directory (or the default directory),
+    optionally only those for the given view (given as
+    'module.function'). Returns None if there are no profiles.
+    """
+    if directory is None:
+        directory = _default_profile_directory()
+    if not os.path.isdir(directory):
+        return None
+    paths = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith('.pstats') and
+        (view_name is None or name.startswith(view_name + '-'))
+        )
+    stats = None
+    for path in paths:
+        try:
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        except (IOError, OSError):
+            # The file was rotated away while we were reading.
+            continue
+    return stats
@@ -0,0 +1,640 @@
+"""
+Encoding helpers used by the response decorators.
+
+As well as json, this module has a registry of other encodings that
+json_response can produce when the client asks for them (see its
+negotiate option). A CBOR encoder is always available, and msgpack is
+used if it is installed.
+"""
+import os
+import json
+import struct
+import binascii
+from json.encoder import encode_basestring_ascii
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class _NeedsStreaming(Exception):
+    """
+    Raised when the fast encoder finds a value it can only encode by
+    iterating over it.
+    """
+    pass
+
+def _refuse_iterables(value):
+    """
+    The default hook for the fast encoder. Anything iterable has to be
+    encoded incrementally, anything else can't be encoded at all.
+    """
+    if hasattr(value, '__iter__'):
+        raise _NeedsStreaming()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+# The standard library's C-accelerated encoder, which we use for any
+# value that doesn't contain an iterator.
+_fast_encode = json.JSONEncoder(default=_refuse_iterables).encode
+
+def _encode_key(key):
+    """
+    Returns the encoded form of a dictionary key, converted to a
+    string in the same way as the json module does.
+    """
+    if isinstance(key, basestring):
+        pass
+    elif key is True:
+        key = 'true'
+    elif key is False:
+        key = 'false'
+    elif key is None:
+        key = 'null'
+    elif isinstance(key, (int, long, float)):
+        key = _fast_encode(key)
+    else:
+        raise TypeError("key " + repr(key) + " is not a string")
+    return _fast_encode(key)
+
+def _encode_float(value):
+    """
+    Returns the json for a float, as the json module writes it.
+    """
+    if value != value:
+        return 'NaN'
+    elif value == _INFINITY:
+        return 'Infinity'
+    elif value == -_INFINITY:
+        return '-Infinity'
+    return repr(value)
+_INFINITY = float('inf')
+
+# Functions that write the json for values of these exact types. Other
+# types are passed to the general encoder.
+_value_writers = {
+    str: encode_basestring_ascii,
+    unicode: encode_basestring_ascii,
+    int: int.__repr__,
+    long: str,
+    float: _encode_float,
+    bool: lambda value: value and 'true' or 'false',
+    type(None): lambda value: 'null'
+    }
+
+def _row_template(keys):
+    """
+    Returns a format string for the json object with the given keys,
+    with a '%s' for each value.
+    """
+    parts = [_encode_key(key).replace('%', '%%') + ': %s' for key in keys]
+    return '{' + ', '.join(parts) + '}'
+
+def _compile_row_writer(keys, types, from_dict):
+    """
+    Returns a function that writes the json object for a row with the
+    given keys, specialized for values of the given types (None for a
+    value of any type). Rows are dictionaries if 'from_dict' is true,
+    otherwise sequences of values in key order. The function returns
+    None for a row of any other shape.
+    """
+    namespace = dict(_template=_row_template(keys), _any=_fast_encode)
+    defaults = ['_template=_template', '_any=_any']
+    lines = ['    if len(row) != %d: return None' % len(keys)]
+    if from_dict and keys:
+        lines.append('    try:')
+        for index, key in enumerate(keys):
+            namespace['k%d' % index] = key
+            defaults.append('k%d=k%d' % (index, index))
+            lines.append('        v%d = row[k%d]' % (index, index))
+        lines.append('    except KeyError: return None')
+    elif keys:
+        lines.append('    %s, = row' % ', '.join(
+            'v%d' % index for index in range(len(keys))
+            ))
+
+    checks = []
+    values = []
+    for index, value_type in enumerate(types):
+        if value_type is None:
+            values.append('_any(v%d)' % index)
+            continue
+        namespace['t%d' % index] = value_type
+        namespace['w%d' % index] = _value_writers[value_type]
+        defaults.append('t%d=t%d, w%d=w%d' % (index, index, index, index))
+        checks.append('type(v%d) is t%d' % (index, index))
+        values.append('w%d(v%d)' % (index, index))
+    if checks:
+        lines.append('    if not (%s): return None' % ' and '.join(checks))
+    lines.append('    return _template %% (%s)' % ''.join(
+        value + ', ' for value in values
+        ))
+
+    source = 'def write(row, %s):\n%s\n' % (
+        ', '.join(defaults), '\n'.join(lines)
+        )
+    exec compile(source, '<row writer>', 'exec') in namespace
+    return namespace['write']
+
+class ShapeEncoder(object):
+    """
+    Encodes dictionaries that all have the same keys, such as the rows
+    of a list endpoint, faster than encoding each one separately. The
+    keys can be given, or are taken from the first row. A writer
+    function is generated for the shape of the rows, with the keys
+    escaped once, up front, and a function chosen for each value from
+    the types in the first row. Writers are generated for the first
+    few combinations of value types seen, and rows that don't fit any
+    of them are passed to the general encoder.
+
+    This only pays off where rows would otherwise be encoded one at a
+    time (as when streaming): the json module encodes a whole list of
+    dictionaries faster than this can.
+    """
+    # Rows are dictionaries, rather than sequences of values.
+    _from_dict = True
+
+    # The most writers generated for different combinations of types.
+    max_variants = 4
+
+    def __init__(self, keys=None):
+        if keys is not None:
+            keys = tuple(keys)
+        self.keys = keys
+        self._writer = None
+        self._variants = {}
+
+    def _write(self, row):
+        """
+        Returns the json for the row with a generated writer, or None
+        if the row doesn't have the right shape.
+        """
+        writer = self._writer
+        if writer is not None:
+            result = writer(row)
+            if result is not None:
+                return result
+        if self.keys is None:
+            self.keys = tuple(row)
+
+        types = self._types(row)
+        if types is None:
+            return None
+        writer = self._variants.get(types)
+        if writer is None:
+            if len(self._variants) >= self.max_variants:
+                return None
+            if self._from_dict and None in types:
+                # The json module is faster for rows with nested values.
+                writer = _fast_encode
+            else:
+                writer = _compile_row_writer(
+                    self.keys, types, self._from_dict
+                    )
+            self._variants[types] = writer
+        self._writer = writer
+        return writer(row)
+
+    def _types(self, row):
+        """
+        Returns the types of the values in the row, with None for any
+        without a specialized writer, or None if the row has the wrong
+        keys.
+        """
+        if len(row) != len(self.keys):
+            return None
+        if self._from_dict:
+            try:
+                row = [row[key] for key in self.keys]
+            except KeyError:
+                return None
+        return tuple([
+            type(value) if type(value) in _value_writers else None
+            for value in row
+            ])
+
+    def encode(self, row):
+        """
+        Returns the json for a dictionary.
+        """
+        if type(row) is dict:
+            try:
+                result = self._write(row)
+            except _NeedsStreaming:
+                result = None
+            if result is not None:
+                return result
+        return encode(row)
+
+    def encode_rows(self, rows):
+        """
+        Returns the json array of the given dictionaries.
+        """
+        return '[' + ', '.join([self.encode(row) for row in rows]) + ']'
+
+class RowEncoder(ShapeEncoder):
+    """
+    Encodes rows given as sequences of values in a fixed order (such as
+    the tuples from values_list), as json objects with the given keys.
+    """
+    _from_dict = False
+
+    def __init__(self, keys):
+        super(RowEncoder, self).__init__(keys)
+        self.template = _row_template(self.keys)
+
+    def encode_values(self, values):
+        """
+        Returns the json object for a sequence of values, in the same
+        order as the keys.
+        """
+        writer = self._writer
+        if writer is not None:
+            result = writer(values)
+            if result is not None:
+                return result
+        result = self._write(values)
+        if result is not None:
+            return result
+        writers = _value_writers
+        return self.template % tuple([
+            writers.get(type(value), _fast_encode)(value) for value in values
+            ])
+
+class ProjectedRows(object):
+    """
+    The rows of a queryset, projected onto the given fields (see the
+    project option of json_response). Iterating gives a dictionary
+    per row, but the encoders here write the json directly from the
+    tuples of values, without creating the dictionaries (or model
+    instances).
+    """
+    def __init__(self, queryset, fields):
+        self.fields = tuple(fields)
+        self.queryset = queryset.values_list(*self.fields)
+
+    def __iter__(self):
+        fields = self.fields
+        for values in self.queryset.iterator():
+            yield dict(zip(fields, values))
+
+    def iterencode(self):
+        """
+        Yields the json array of the rows, one row at a time.
+        """
+        encode_values = RowEncoder(self.fields).encode_values
+        yield '['
+        first = True
+        for values in self.queryset.iterator():
+            if first:
+                first = False
+                yield encode_values(values)
+            else:
+                yield ', ' + encode_values(values)
+        yield ']'
+
+def _iterencode(value):
+    """
+    Yields the parts of the json encoding of the given value. The
+    value is encoded in one step, with a placeholder for each iterator
+    in it, and the iterators are then encoded in turn, in place of
+    their placeholders, so nothing is encoded more than once. The
+    placeholders include a random token, so they can't be forged by
+    strings in the value.
+    """
+    iterables = []
+    token = []
+    def _defer_iterables(item):
+        if hasattr(item, '__iter__'):
+            if not token:
+                token.append(binascii.hexlify(os.urandom(8)))
+            iterables.append(item)
+            return u'\x00%s:%d' % (token[0], len(iterables) - 1)
+        raise TypeError(repr(item) + " is not JSON serializable")
+    text = json.JSONEncoder(default=_defer_iterables).encode(value)
+    if not iterables:
+        yield text
+        return
+
+    # Each placeholder is encoded as "\u0000<token>:<index>".
+    parts = text.split('"\\u0000%s:' % token[0])
+    if parts[0]:
+        yield parts[0]
+    for placeholder in parts[1:]:
+        index, rest = placeholder.split('"', 1)
+        for part in _iterencode_iterable(iterables[int(index)]):
+            yield part
+        if rest:
+            yield rest
+
+def _iterencode_iterable(value):
+    """
+    Yields the parts of the json array for an iterable. Each item is
+    tried with the fast encoder first, since items rarely contain more
+    iterators.
+    """
+    if isinstance(value, ProjectedRows):
+        for part in value.iterencode():
+            yield part
+        return
+
+    # Querysets are iterated with iterator(), so the results aren't
+    # also cached in the queryset as we go.
+    if hasattr(value, 'iterator') and hasattr(value, 'model'):
+        value = value.iterator()
+    # Dictionaries in the array (such as the rows of a values()
+    # queryset) usually all have the same keys.
+    write = ShapeEncoder()._write
+    yield '['
+    separator = ''
+    for item in value:
+        try:
+            if type(item) is dict:
+                part = write(item)
+            else:
+                part = _fast_encode(item)
+        except _NeedsStreaming:
+            part = None
+        if part is not None:
+            yield separator + part
+            separator = ', '
+            continue
+        if separator:
+            yield separator
+        separator = ', '
+        for part in _iterencode(item):
+            yield part
+    yield ']'
+
+def iterencode(value, chunk_size=16384):
+    """
+    Yields the json encoding of the given value, in chunks of roughly
+    the given number of characters. Generators, iterators and
+    querysets anywhere in the value are encoded as arrays, without
+    first being turned into lists, so the whole result never has to be
+    held in memory at once.
+    """
+    return _chunked(_iterencode(value), chunk_size)
+
+def _chunked(parts, chunk_size):
+    """
+    Yields the given parts of an encoding joined together into chunks
+    of at least the given size (apart from the last).
+    """
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+def encode(value):
+    """
+    Returns the json encoding of the given value as a string. This is
+    the same as json.dumps, except that generators, querysets and
+    other iterables are encoded as arrays.
+    """
+    try:
+        return _fast_encode(value)
+    except _NeedsStreaming:
+        return ''.join(_iterencode(value))
+
+
+# CBOR (RFC 7049) encoding.
+def _cbor_head(major, length):
+    """
+    Returns the initial bytes of a CBOR item with the given major type
+    and length (or value, for integers).
+    """
+    major <<= 5
+    if length < 24:
+        return chr(major | length)
+    elif length < 0x100:
+        return chr(major | 24) + chr(length)
+    elif length < 0x10000:
+        return struct.pack('>BH', major | 25, length)
+    elif length < 0x100000000:
+        return struct.pack('>BI', major | 26, length)
+    else:
+        return struct.pack('>BQ', major | 27, length)
+
+def _cbor_int(value):
+    if value >= 0:
+        if value < 0x10000000000000000:
+            return _cbor_head(0, value)
+        tag, value = '\xc2', value
+    else:
+        if value >= -0x10000000000000000:
+            return _cbor_head(1, -1 - value)
+        tag, value = '\xc3', -1 - value
+    # Integers that don't fit in 64 bits are tagged big-endian bignums.
+    digits = '%x' % value
+    data = ('0' * (len(digits) % 2) + digits).decode('hex')
+    return tag + _cbor_head(2, len(data)) + data
+
+def _cbor_float(value):
+    # Use single precision where it doesn't lose anything.
+    try:
+        single = struct.pack('>f', value)
+        if struct.unpack('>f', single)[0] == value:
+            return '\xfa' + single
+    except OverflowError:
+        pass
+    return '\xfb' + struct.pack('>d', value)
+
+def _cbor_unicode(value):
+    data = value.encode('utf-8')
+    return _cbor_head(3, len(data)) + data
+
+def _cbor_str(value):
+    # Byte strings are text, as they are for json.
+    return _cbor_head(3, len(value)) + value
+
+def _cbor_bytearray(value):
+    return _cbor_head(2, len(value)) + str(value)
+
+# Functions that write the CBOR for scalar values of these exact types.
+_cbor_writers = {
+    int: _cbor_int,
+    long: _cbor_int,
+    float: _cbor_float,
+    unicode: _cbor_unicode,
+    str: _cbor_str,
+    bytearray: _cbor_bytearray,
+    bool: lambda value: value and '\xf5' or '\xf4',
+    type(None): lambda value: '\xf6'
+    }
+
+def _cbor_write(value, out):
+    """
+    Appends the CBOR encoding of the value to the out list. Raises
+    _NeedsStreaming if the value contains an iterator.
+    """
+    writer = _cbor_writers.get(type(value))
+    if writer is not None:
+        out.append(writer(value))
+    elif isinstance(value, (list, tuple)):
+        out.append(_cbor_head(4, len(value)))
+        for item in value:
+            _cbor_write(item, out)
+    elif isinstance(value, dict):
+        out.append(_cbor_head(5, len(value)))
+        for key, item in value.iteritems():
+            _cbor_write(key, out)
+            _cbor_write(item, out)
+    elif hasattr(value, '__iter__'):
+        raise _NeedsStreaming()
+    else:
+        # Subclasses of the scalar types.
+        for value_type, writer in _cbor_writers.items():
+            if isinstance(value, value_type):
+                out.append(writer(value))
+                return
+        raise TypeError(repr(value) + " is not CBOR serializable")
+
+def _iterencode_cbor(value):
+    """
+    Yields the parts of the CBOR encoding of the value. Iterators are
+    written as indefinite-length arrays, so they are never turned into
+    lists.
+    """
+    out = []
+    try:
+        _cbor_write(value, out)
+        yield ''.join(out)
+        return
+    except _NeedsStreaming:
+        pass
+
+    if isinstance(value, ProjectedRows):
+        keys = []
+        for key in value.fields:
+            _cbor_write(key, keys)
+        yield '\x9f'
+        head = _cbor_head(5, len(keys))
+        for values in value.queryset.iterator():
+            out = [head]
+            for key, item in zip(keys, values):
+                out.append(key)
+                _cbor_write(item, out)
+            yield ''.join(out)
+        yield '\xff'
+    elif isinstance(value, dict):
+        yield _cbor_head(5, len(value))
+        for key, item in value.iteritems():
+            out = []
+            _cbor_write(key, out)
+            yield ''.join(out)
+            for part in _iterencode_cbor(item):
+                yield part
+    elif isinstance(value, (list, tuple)):
+        yield _cbor_head(4, len(value))
+        for item in value:
+            for part in _iterencode_cbor(item):
+                yield part
+    else:
+        if hasattr(value, 'iterator') and hasattr(value, 'model'):
+            value = value.iterator()
+        yield '\x9f'
+        for item in value:
+            for part in _iterencode_cbor(item):
+                yield part
+        yield '\xff'
+
+def encode_cbor(value):
+    """
+    Returns the CBOR encoding of the given value, which can contain
+    the same things as a json_response result.
+    """
+    out = []
+    try:
+        _cbor_write(value, out)
+        return ''.join(out)
+    except _NeedsStreaming:
+        return ''.join(_iterencode_cbor(value))
+
+def iterencode_cbor(value, chunk_size=16384):
+    """
+    Yields the CBOR encoding of the given value in chunks, as
+    iterencode does for json.
+    """
+    return _chunked(_iterencode_cbor(value), chunk_size)
+
+# msgpack encoding, if it is installed.
+def _msgpack_default(value):
+    if hasattr(value, '__iter__'):
+        return list(value)
+    raise TypeError(repr(value) + " is not msgpack serializable")
+
+def encode_msgpack(value):
+    """
+    Returns the msgpack encoding of the given value. Iterators are
+    turned into lists first.
+    """
+    return msgpack.packb(value, default=_msgpack_default)
+
+# The registry of encodings.
+class Encoding(object):
+    """
+    A way of encoding results for json_response: a content type, a
+    function that returns the encoded value as a string and, if the
+    encoding can be streamed, a function that yields it in chunks.
+    """
+    def __init__(self, content_type, encode, iterencode=None):
+        self.content_type = content_type
+        self.encode = encode
+        self.iterencode = iterencode
+
+_encodings = []
+
+def register_encoding(content_type, encode, iterencode=None):
+    """
+    Adds an encoding that json_response can negotiate. Registering a
+    content type again replaces the earlier encoding. When the client
+    has no preference, earlier encodings are preferred.
+    """
+    encoding = Encoding(content_type, encode, iterencode)
+    for i, existing in enumerate(_encodings):
+        if existing.content_type == content_type:
+            _encodings[i] = encoding
+            return encoding
+    _encodings.append(encoding)
+    return encoding
+
+JSON = register_encoding('application/json', encode, iterencode)
+CBOR = register_encoding('application/cbor', encode_cbor, iterencode_cbor)
+if msgpack is not None:
+    register_encoding('application/msgpack', encode_msgpack)
+    register_encoding('application/x-msgpack', encode_msgpack)
+
+def negotiate(accept):
+    """
+    Returns the registered encoding that best matches the given Accept
+    header, defaulting to json if none of them is named in it. Ties go
+    to the encoding registered first.
+    """
+    if not accept:
+        return JSON
+    qualities = dict()
+    for media_range in accept.split(','):
+        parts = media_range.split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[parts[0].strip().lower()] = quality
+
+    best = JSON
+    best_quality = 0.0
+    for encoding in _encodings:
+        quality = qualities.get(encoding.content_type, 0.0)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
@@ -1,6 +1,43 @@
-import ido
-import uuid_field as uuid
-import json_field as json
-import pickle_field as pickle
-import password_field as password
-import slug
+"""
+The field modules, available as dj_utils.fields.ido, .uuid, .json,
+.pickle, .password and .slug. Each is only imported when it is first
+used, so a project using one field doesn't pay for importing them all
+(the password field, in particular, needs django.contrib.auth).
+"""
+import sys
+import types
+import importlib
+
+# The field modules, by the names they are available as here.
+_submodules = dict(
+    ido='ido', uuid='uuid_field', json='json_field', pickle='pickle_field',
+    password='password_field', slug='slug'
+    )
+
+class _LazyPackage(types.ModuleType):
+    """
+    This package, importing its field modules on attribute access.
+    """
+    def __getattr__(self, name):
+        if name not in _submodules:
+            raise AttributeError(
+                "'module' object has no attribute '%s'" % name
+                )
+        module = importlib.import_module(
+            '%s.%s' % (self.__name__, _submodules[name])
+            )
+        setattr(self, name, module)
+        return module
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_submodules))
+
+# Replace this module with the lazy version, keeping a reference to
+# the original, since its globals are cleared when it is collected.
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(
+    (name, value) for name, value in globals().items()
+    if name.startswith('__')
+    )
+_package._original = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -1,8 +1,12 @@
+import time
 import random
 
 from django.db import models
 import django.dispatch as dispatcher
 
+import dj_utils.metrics as metrics
+from introspection import add_introspection_rules
+
 class IdObfuscator(object):
     """
     A utility class that implements an n-bit mixing algorithm which
@@ -188,13 +192,25 @@ class ObfuscatedIdField(models.CharField):
         """
         source_val = getattr(instance, self.source_field)
         if source_val:
-            oid = self.ido.get_obfuscated_id(source_val)
+            oid = self._obfuscate(source_val)
             setattr(instance, self.name, oid)
         else:
             # Use null as a temporary oid, we'll create the real one
             # post-save.
             setattr(instance, self.name, None)
 
+    def _obfuscate(self, value):
+        """
+        Returns the obfuscated id for the value of the source field,
+        recording the time it took in the metrics, if they're enabled.
+        """
+        if metrics.collector is None:
+            return self.ido.get_obfuscated_id(value)
+        start = time.time()
+        oid = self.ido.get_obfuscated_id(value)
+        metrics.record(self, 'obfuscate', time.time() - start)
+        return oid
+
     def _post_save(self, sender, instance, *args, **kws):
         """
         Update this field, if we didn't do it in pre_save.
@@ -208,7 +224,7 @@ class ObfuscatedIdField(models.CharField):
                 )
 
             # Create the oid.
-            oid = self.ido.get_obfuscated_id(source_val)
+            oid = self._obfuscate(source_val)
             setattr(instance, self.name, oid)
 
             # Do another save to save the oid.
@@ -216,19 +232,15 @@ class ObfuscatedIdField(models.CharField):
 
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(
-        [(
-                [ObfuscatedIdField],
-                [],
-                {
-                    "seed": ("ido.seed", {}),
-                    "bits": ("ido.bits", {}),
-                    "source_field": ("source_field", {"default":"id"})
-                }
-        )],
-        ["^dj_utils\.fields\.ido\.ObfuscatedIdField"]
-        )
-except ImportError:
-    pass
+add_introspection_rules(
+    [(
+            [ObfuscatedIdField],
+            [],
+            {
+                "seed": ("ido.seed", {}),
+                "bits": ("ido.bits", {}),
+                "source_field": ("source_field", {"default":"id"})
+            }
+    )],
+    ["^dj_utils\.fields\.ido\.ObfuscatedIdField"]
+    )
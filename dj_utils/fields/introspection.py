@@ -0,0 +1,38 @@
+"""
+Registers the fields with South's model introspection, if South is
+installed. Rules are held until the first model class is prepared,
+so importing a field module doesn't mean looking for South (which is
+a search of the whole path when it isn't installed), and it is looked
+for once, not once per field module.
+"""
+from django.db.models import signals
+
+# The (rules, patterns) waiting to be passed to South.
+_pending = []
+
+def add_introspection_rules(rules=[], patterns=[]):
+    """
+    Registers the given rules and patterns with South's
+    add_introspection_rules, when the first model is prepared.
+    """
+    if not _pending:
+        signals.class_prepared.connect(
+            _register, dispatch_uid='dj_utils.fields.introspection'
+            )
+    _pending.append((rules, patterns))
+
+def _register(sender, **kws):
+    """
+    Passes any pending rules to South, if it is installed.
+    """
+    signals.class_prepared.disconnect(
+        _register, dispatch_uid='dj_utils.fields.introspection'
+        )
+    pending = _pending[:]
+    del _pending[:]
+    try:
+        from south.modelsinspector import add_introspection_rules
+    except ImportError:
+        return
+    for rules, patterns in pending:
+        add_introspection_rules(rules, patterns)
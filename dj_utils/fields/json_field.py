@@ -1,5 +1,7 @@
+import re
 import json
 import zlib
+import time
 import base64
 
 from django.db import models
@@ -9,12 +11,255 @@ from datetime import datetime
 from django.db import models
 from django.utils.encoding import force_unicode
 
+import dj_utils.metrics as metrics
+from introspection import add_introspection_rules
+
 def dbsafe_encode(value):
-    return base64.b64encode(zlib.compress(json.dumps(value)))
+    return _pack(json.dumps(value))
+
+def _pack(text):
+    return base64.b64encode(zlib.compress(text))
 
 def dbsafe_decode(value, compress_object=False):
     return json.loads(zlib.decompress(base64.b64decode(value)))
 
+def iter_decode(value, path=None, chunk_size=65536):
+    """
+    Yields the items of an array in an encoded value, one at a time,
+    without decoding the whole value. The path gives the keys (for
+    objects) and indices (for arrays) that lead from the top of the
+    value to the array, e.g. ('pages', 0, 'events'), or can be a
+    single key, or None for a top level array. The value is
+    decompressed and parsed in chunks of around chunk_size bytes, and
+    each item is only decoded when it is reached, so memory use is
+    bounded by the size of the items, and stopping early saves the
+    work of decoding the rest.
+
+    Raises KeyError if the path isn't in the value, and ValueError if
+    it doesn't lead to an array.
+    """
+    if path is None:
+        path = ()
+    elif isinstance(path, (basestring, int, long)):
+        path = (path,)
+    reader = _JSONReader(_decompressed_chunks(value, chunk_size))
+    for step in path:
+        reader.find(step)
+    return reader.iter_array()
+
+def _decompressed_chunks(value, chunk_size):
+    """
+    Yields the json text of an encoded value, in chunks of at most
+    roughly chunk_size bytes.
+    """
+    decompressor = zlib.decompressobj()
+    # Base64 decodes in groups of four characters.
+    step = max(chunk_size // 4, 1) * 4
+    for start in xrange(0, len(value), step):
+        data = base64.b64decode(value[start:start + step])
+        while data:
+            chunk = decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+            data = decompressor.unconsumed_tail
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+class _JSONReader(object):
+    """
+    Reads through json text given in chunks, finding values by key or
+    index, skipping over the values in the way without decoding them,
+    and decoding the items of an array one at a time.
+    """
+    # Patterns for the rest of a string after its opening quote, the
+    # next character significant to nesting, and scalar values.
+    _string_rest = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+    _structure = re.compile(r'["\[\]{}]')
+    _scalar = re.compile(r'[^\s,\]}]*')
+    _space = re.compile(r'\s*')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text = ''
+        self.position = 0
+        self.finished = False
+        self.decode = json.JSONDecoder().raw_decode
+
+    def _more(self):
+        """
+        Reads another chunk, dropping the text we've finished with.
+        Returns False if there isn't any more.
+        """
+        for chunk in self.chunks:
+            self.text = self.text[self.position:] + chunk
+            self.position = 0
+            return True
+        self.finished = True
+        return False
+
+    def _peek(self):
+        """
+        Skips whitespace, and returns the next character ('' at the end).
+        """
+        while True:
+            self.position = self._space.match(self.text, self.position).end()
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self._more():
+                return ''
+
+    def _expect(self, characters):
+        """
+        Consumes and returns the next character, if it is one of the
+        given characters, otherwise raises ValueError.
+        """
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError(
+                "Expected one of '%s' at %r" % (characters, character)
+                )
+        self.position += 1
+        return character
+
+    def _value(self):
+        """
+        Decodes and returns the next value. It must be followed by the
+        punctuation that can follow a value, so that a number cut off
+        at the end of a chunk isn't mistaken for a shorter one.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decode(self.text, self.position)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            following = self._space.match(self.text, end).end()
+            if self.text[following:following + 1] in (',', ']', '}', ':') \
+                    or not self._more():
+                self.position = end
+                return value
+
+    def _skip(self):
+        """
+        Moves past the next value without decoding it.
+        """
+        character = self._peek()
+        if character == '"':
+            self.position += 1
+            self._skip_string()
+        elif character in ('[', '{'):
+            self.position += 1
+            depth = 1
+            while depth:
+                match = self._structure.search(self.text, self.position)
+                if match is None:
+                    self.position = len(self.text)
+                    if not self._more():
+                        raise ValueError("Unexpected end of json")
+                    continue
+                self.position = match.end()
+                character = match.group()
+                if character == '"':
+                    self._skip_string()
+                elif character in '[{':
+                    depth += 1
+                else:
+                    depth -= 1
+        else:
+            while True:
+                end = self._scalar.match(self.text, self.position).end()
+                if end < len(self.text) or not self._more():
+                    break
+            if end == self.position:
+                raise ValueError("Expected a value at %r" % character)
+            self.position = end
+
+    def _skip_string(self):
+        """
+        Moves past the rest of a string, after its opening quote.
+        """
+        while True:
+            match = self._string_rest.match(self.text, self.position)
+            if match is not None:
+                self.position = match.end()
+                return
+            if not self._more():
+                raise ValueError("Unterminated string")
+
+    def find(self, step):
+        """
+        Moves to the value at the given key of the object, or index of
+        the array, that comes next.
+        """
+        if isinstance(step, (int, long)):
+            if self._peek() != '[':
+                raise KeyError(step)
+            self.position += 1
+            for index in xrange(step + 1):
+                if self._peek() == ']':
+                    break
+                if index:
+                    self._expect(',')
+                if index == step:
+                    return
+                self._skip()
+        else:
+            if self._peek() != '{':
+                raise KeyError(step)
+            self.position += 1
+            while self._peek() != '}':
+                key = self._value()
+                self._expect(':')
+                if key == step:
+                    return
+                self._skip()
+                if self._expect(',}') == '}':
+                    break
+        raise KeyError(step)
+
+    def iter_array(self):
+        """
+        Returns an iterator over the items of the array that comes next.
+        """
+        if self._peek() != '[':
+            raise ValueError("Expected an array")
+        self.position += 1
+        return self._items()
+
+    def _items(self):
+        """
+        Yields the items of the array we are in.
+        """
+        if self._peek() == ']':
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+def _iter_loaded(value, path):
+    """
+    Yields the items of the array at the given path in a value that
+    has already been decoded, in the same way as iter_decode.
+    """
+    if path is None:
+        path = ()
+    elif isinstance(path, (basestring, int, long)):
+        path = (path,)
+    for step in path:
+        if isinstance(step, (int, long)) != isinstance(value, list):
+            raise KeyError(step)
+        try:
+            value = value[step]
+        except (IndexError, KeyError):
+            raise KeyError(step)
+    if not isinstance(value, list):
+        raise ValueError("Expected an array")
+    return iter(value)
+
 class JSONObject(str):
     pass
 
@@ -40,6 +285,27 @@ class JSONField(models.TextField):
             return json.dumps(getattr(model_instance, self.attname, None))
         setattr(cls, 'get_%s_json' % self.name, get_json)
 
+        def iter_items(model_instance, path=None):
+            """
+            Yields the items of the array at the given path in the
+            value (see iter_decode). If the field has been deferred,
+            the stored value is fetched and decoded as it is iterated,
+            rather than being loaded in full.
+            """
+            if self.attname in model_instance.__dict__:
+                return _iter_loaded(
+                    getattr(model_instance, self.attname), path
+                    )
+            stored = self.model._base_manager.using(
+                model_instance._state.db
+                ).filter(pk=model_instance.pk).values_list(
+                self.attname, flat=True
+                )[0]
+            if stored is None:
+                return iter(())
+            return iter_decode(stored, path)
+        setattr(cls, 'iter_%s' % self.name, iter_items)
+
     def get_default(self):
         """
         Returns the default value for this field without forcing
@@ -58,18 +324,42 @@ class JSONField(models.TextField):
         """
         if value is not None:
             try:
-                value = dbsafe_decode(value)
+                if metrics.collector is None:
+                    value = dbsafe_decode(value)
+                else:
+                    value = self._measured_decode(value)
             except:
                 if isinstance(value, JSONObject):
                     raise
         return value
 
+    def _measured_decode(self, stored):
+        """
+        Decodes the value, recording the time and sizes in the metrics.
+        """
+        start = time.time()
+        text = zlib.decompress(base64.b64decode(stored))
+        value = json.loads(text)
+        metrics.record(
+            self, 'decode', time.time() - start, len(text), len(stored)
+            )
+        return value
+
     def get_db_prep_value(self, value, *args, **kws):
         """
         JSON and b64encode the object.
         """
         if value is not None and not isinstance(value, JSONObject):
-            value = force_unicode(dbsafe_encode(value))
+            if metrics.collector is None:
+                value = force_unicode(dbsafe_encode(value))
+            else:
+                start = time.time()
+                text = json.dumps(value)
+                stored = _pack(text)
+                metrics.record(
+                    self, 'encode', time.time() - start, len(text), len(stored)
+                    )
+                value = force_unicode(stored)
         return value
 
     def value_to_string(self, obj):
@@ -86,10 +376,6 @@ class JSONField(models.TextField):
             )
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(
-        [], ["^dj_utils\.fields\.json_field\.JSONField"]
-        )
-except ImportError:
-    pass
+add_introspection_rules(
+    [], ["^dj_utils\.fields\.json_field\.JSONField"]
+    )
@@ -3,16 +3,34 @@ import hashlib
 
 import django.forms as forms
 from django.db import models
-import django.contrib.auth.models as auth_models
 
-# Django 1.3 used a get_hexdigest method for password settiing and
-# checking, in 1.4 it moved to pluggable hashing, we need to behave
-# differently in each case.
-try:
-    from django.contrib.auth.models import get_hexdigest, check_password
-except ImportError:
-    get_hexdigest = None
-    from django.contrib.auth.hashers import make_password, check_password
+from introspection import add_introspection_rules
+
+_hashers = None
+def _get_hashers():
+    """
+    Returns the get_hexdigest, make_password and check_password
+    functions from django.contrib.auth, importing them when first
+    needed, since django.contrib.auth is slow to import.
+
+    Django 1.3 used a get_hexdigest method for password settiing and
+    checking, in 1.4 it moved to pluggable hashing, we need to behave
+    differently in each case (in 1.4 get_hexdigest is None, in 1.3
+    make_password is).
+    """
+    global _hashers
+    if _hashers is None:
+        try:
+            from django.contrib.auth.models import (
+                get_hexdigest, check_password
+                )
+            _hashers = (get_hexdigest, None, check_password)
+        except ImportError:
+            from django.contrib.auth.hashers import (
+                make_password, check_password
+                )
+            _hashers = (None, make_password, check_password)
+    return _hashers
 
 class PasswordField(models.CharField):
     """
@@ -37,6 +55,7 @@ class PasswordField(models.CharField):
             """
             algorithm = 'sha1'
             salt = str(uuid.uuid4())
+            get_hexdigest, make_password, check = _get_hashers()
             if get_hexdigest:
                 hsh = get_hexdigest(algorithm, salt, raw_password)
                 dbvalue = "%s$%s$%s" % (algorithm, salt, hsh)
@@ -54,7 +73,8 @@ class PasswordField(models.CharField):
             if not current:
                 return not raw_password
             else:
-                return auth_models.check_password(raw_password, current)
+                check = _get_hashers()[2]
+                return check(raw_password, current)
 
         setattr(cls, 'set_%s' % self.name, set_password)
         setattr(cls, 'check_%s' % self.name, check_password)
@@ -68,17 +88,13 @@ class PasswordField(models.CharField):
         return super(PasswordField, self).formfield(**defaults)
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(
-        [(
-                [PasswordField],
-                [],
-                {
-                    "algorithm": ("algorithm", {"default":"sha1"})
-                }
-        )],
-        ["^dj_utils\.fields\.password_field\.PasswordField"]
-        )
-except ImportError:
-    pass
+add_introspection_rules(
+    [(
+            [PasswordField],
+            [],
+            {
+                "algorithm": ("algorithm", {"default":"sha1"})
+            }
+    )],
+    ["^dj_utils\.fields\.password_field\.PasswordField"]
+    )
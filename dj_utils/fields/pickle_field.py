@@ -7,6 +7,7 @@ which in turn was based on obeattie's snippet at:
 http://djangosnippets.org/snippets/513/
 """
 
+import time
 from copy import deepcopy
 from base64 import b64encode, b64decode
 from zlib import compress, decompress
@@ -18,6 +19,9 @@ except ImportError:
 from django.db import models
 from django.utils.encoding import force_unicode
 
+import dj_utils.metrics as metrics
+from introspection import add_introspection_rules
+
 class PickledObject(str):
     """
     A subclass of string so it can be told whether a string is a
@@ -44,10 +48,13 @@ def dbsafe_encode(value, compress_object=False):
     same for the lookups to work properly. See tests.py for more
     information.
     """
+    return _pack(dumps(deepcopy(value)), compress_object)
+
+def _pack(pickled, compress_object=False):
     if not compress_object:
-        value = b64encode(dumps(deepcopy(value)))
+        value = b64encode(pickled)
     else:
-        value = b64encode(compress(dumps(deepcopy(value))))
+        value = b64encode(compress(pickled))
     return PickledObject(value)
 
 def dbsafe_decode(value, compress_object=False):
@@ -122,7 +129,10 @@ class PickledObjectField(models.TextField):
         """
         if value is not None:
             try:
-                value = dbsafe_decode(value, self.compress)
+                if metrics.collector is None:
+                    value = dbsafe_decode(value, self.compress)
+                else:
+                    value = self._measured_decode(value)
             except:
                 # If the value is a definite pickle; and an error is raised in
                 # de-pickling it should be allowed to propogate.
@@ -148,7 +158,36 @@ class PickledObjectField(models.TextField):
             # store it like it would a string), but since both of
             # these methods result in the same value being stored,
             # doing things this way is much easier.
-            value = force_unicode(dbsafe_encode(value, self.compress))
+            if metrics.collector is None:
+                value = force_unicode(dbsafe_encode(value, self.compress))
+            else:
+                value = force_unicode(self._measured_encode(value))
+        return value
+
+    def _measured_encode(self, value):
+        """
+        Encodes the value, recording the time and sizes in the metrics.
+        """
+        start = time.time()
+        pickled = dumps(deepcopy(value))
+        stored = _pack(pickled, self.compress)
+        metrics.record(
+            self, 'encode', time.time() - start, len(pickled), len(stored)
+            )
+        return stored
+
+    def _measured_decode(self, stored):
+        """
+        Decodes the value, recording the time and sizes in the metrics.
+        """
+        start = time.time()
+        pickled = b64decode(stored)
+        if self.compress:
+            pickled = decompress(pickled)
+        value = loads(pickled)
+        metrics.record(
+            self, 'decode', time.time() - start, len(pickled), len(stored)
+            )
         return value
 
     def value_to_string(self, obj):
@@ -165,10 +204,6 @@ class PickledObjectField(models.TextField):
             )
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(
-        [], ["^dj_utils\.fields\.pickle_field\.PickleField"]
-        )
-except ImportError:
-    pass
+add_introspection_rules(
+    [], ["^dj_utils\.fields\.pickle_field\.PickleField"]
+    )
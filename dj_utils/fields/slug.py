@@ -6,12 +6,18 @@ hyphen consecutively within it. So foo-bar is valid, but foo-bar- and
 foo--bar are not.
 """
 import re
+import codecs
+import string
+import unicodedata
 
 import django.db.models as models
 import django.forms as forms
 import django.core.validators as validators
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext as _
 
+from introspection import add_introspection_rules
+
 default_error = _(
     u"Slugs must consist of lower case letters, numbers and hyphens, starting "
     u"and ending with a letter or a number. The slug may not "
@@ -27,6 +33,87 @@ validate_restricted_slug = validators.RegexValidator(
     restricted_slug_re, default_error, 'invalid'
     )
 
+# A byte translation table that lower-cases ASCII letters, keeps
+# digits, and turns every other character into a space. Runs of spaces
+# are then collapsed by str.split, which also trims the ends, so the
+# joined result can never contain leading, trailing or doubled hyphens.
+_slug_table = [' '] * 256
+for _c in string.ascii_lowercase + string.digits:
+    _slug_table[ord(_c)] = _c
+for _c in string.ascii_uppercase:
+    _slug_table[ord(_c)] = _c.lower()
+_slug_table = ''.join(_slug_table)
+del _c
+
+# Runs of non-ASCII characters are folded to ASCII by a codec error
+# handler, one run at a time. The folded runs are cached, because
+# catalog data tends to repeat the same handful of accented words.
+_folded_runs = {}
+_max_folded_runs = 10000
+
+def _fold_non_ascii(err):
+    """
+    A unicode encoding error handler that replaces a run of non-ASCII
+    characters with its ASCII version, with accents removed and
+    anything else replaced by a space.
+    """
+    run = err.object[err.start:err.end]
+    try:
+        return _folded_runs[run], err.end
+    except KeyError:
+        folded = u''.join(
+            c if c < u'\x80' else u' '
+            for c in unicodedata.normalize('NFKD', run)
+            if not unicodedata.combining(c)
+            )
+        if len(_folded_runs) < _max_folded_runs:
+            _folded_runs[run] = folded
+        return folded, err.end
+codecs.register_error('dj_utils.restricted_slug', _fold_non_ascii)
+
+def _to_ascii(text):
+    """
+    Returns an ASCII byte string version of the given text, or an
+    empty string for None.
+    """
+    if not isinstance(text, unicode):
+        text = u'' if text is None else force_unicode(text)
+    return text.encode('ascii', 'dj_utils.restricted_slug')
+
+def restricted_slugify(text, max_length=None, default=None):
+    """
+    Converts arbitrary text into a slug that passes
+    validate_restricted_slug. Letters are lower-cased and accents
+    removed, and any run of other characters becomes a single hyphen.
+
+    If max_length is given the slug is truncated to at most that many
+    characters. If the text is None, or contains nothing that can be
+    used in a slug, then the default is returned instead (it is not
+    validated).
+    """
+    slug = '-'.join(_to_ascii(text).translate(_slug_table).split())
+    if max_length is not None and len(slug) > max_length:
+        slug = slug[:max_length].rstrip('-')
+    return slug or default
+
+def restricted_slugify_many(texts, max_length=None, default=None):
+    """
+    Returns a list of slugs for the given sequence of texts, with the
+    same behavior as restricted_slugify. This is intended for bulk
+    imports, where the per-call overhead would otherwise dominate.
+    """
+    table = _slug_table
+    to_ascii = _to_ascii
+    join = '-'.join
+    result = []
+    append = result.append
+    for text in texts:
+        slug = join(to_ascii(text).translate(table).split())
+        if max_length is not None and len(slug) > max_length:
+            slug = slug[:max_length].rstrip('-')
+        append(slug or default)
+    return result
+
 # The slug form field that is used, by default, by the new slug field.
 class RestrictedSlugFormField(forms.SlugField):
     default_error_messages = {'invalid': default_error}
@@ -40,10 +127,6 @@ class RestrictedSlugField(models.SlugField):
         return super(RestrictedSlugField, self).formfield(**defaults)
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(
-        [], ["^dj_utils\.fields\.slug\.RestrictedSlugField"]
-        )
-except ImportError:
-    pass
+add_introspection_rules(
+    [], ["^dj_utils\.fields\.slug\.RestrictedSlugField"]
+    )
@@ -1,6 +1,8 @@
 import uuid
 from django.db import models
 
+from introspection import add_introspection_rules
+
 class UUIDField(models.CharField):
     """
     A field that holds the ISO-standard format of a random 128-bit UUID.
@@ -22,8 +24,4 @@ class UUIDField(models.CharField):
 
 
 # If we're using south for schema migration, then register this field.
-try:
-    from south.modelsinspector import add_introspection_rules
-    add_introspection_rules([], ["^dj_utils\.fields\.uuid_field\.UUIDField"])
-except ImportError:
-    pass
+add_introspection_rules([], ["^dj_utils\.fields\.uuid_field\.UUIDField"])
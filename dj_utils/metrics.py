@@ -0,0 +1,144 @@
+"""
+Opt-in metrics for the work done by the fields in dj_utils.fields:
+encoding and decoding in the json and pickle fields, and obfuscating
+ids in the obfuscated id field. Nothing is recorded (and the fields
+only check a module attribute) until a collector is enabled:
+
+    from dj_utils import metrics
+    metrics.enable()
+    ...
+    print metrics.dump()
+
+Any object with a record method can be a collector, so the figures
+can be sent on to a metrics system instead.
+"""
+import threading
+
+# The collector being used, or None if metrics are disabled. The
+# fields check this directly, so that being disabled costs nothing.
+collector = None
+
+def enable(new_collector=None):
+    """
+    Starts recording metrics with the given collector (by default a
+    new MemoryCollector), and returns it.
+    """
+    global collector
+    if new_collector is None:
+        new_collector = MemoryCollector()
+    collector = new_collector
+    return collector
+
+def disable():
+    """
+    Stops recording metrics.
+    """
+    global collector
+    collector = None
+
+def record(field, operation, seconds, raw_size=None, stored_size=None):
+    """
+    Passes a measurement of an operation on the given model field to
+    the collector, if there is one. The sizes are those of the value
+    before and after compression and encoding, where they apply.
+    Fields that aren't on a model are recorded under the model '-'.
+    """
+    if collector is not None:
+        model = getattr(field, 'model', None)
+        if model is None:
+            model = '-'
+        else:
+            model = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        collector.record(
+            model, field.name, operation, seconds, raw_size, stored_size
+            )
+
+def dump():
+    """
+    Returns a text report of the metrics recorded so far.
+    """
+    if collector is None:
+        return "Metrics are disabled.\n"
+    return collector.dump()
+
+class Collector(object):
+    """
+    The interface for collectors. Subclasses override record, and dump
+    if they can report on what they have recorded.
+    """
+    def record(self, model, field, operation, seconds,
+               raw_size=None, stored_size=None):
+        """
+        Records one operation (e.g. 'encode') on a field of a model
+        (given by name), taking the given number of seconds.
+        """
+        raise NotImplementedError()
+
+    def dump(self):
+        """
+        Returns a text report of the metrics.
+        """
+        return "%s doesn't keep metrics.\n" % self.__class__.__name__
+
+class MemoryCollector(Collector):
+    """
+    Keeps a count and total time for each operation on each field,
+    along with histograms of the sizes of the values, in buckets of
+    powers of two bytes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, model, field, operation, seconds,
+               raw_size=None, stored_size=None):
+        key = (model, field, operation)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = dict(
+                    count=0, seconds=0.0, raw={}, stored={}
+                    )
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            for name, size in (('raw', raw_size), ('stored', stored_size)):
+                if size is not None:
+                    bucket = 1 << max(size - 1, 0).bit_length()
+                    stats[name][bucket] = stats[name].get(bucket, 0) + 1
+
+    def reset(self):
+        """
+        Forgets everything recorded so far.
+        """
+        with self.lock:
+            self.stats.clear()
+
+    def dump(self):
+        lines = ["%-40s %-10s %8s %12s %10s" % (
+            'field', 'operation', 'calls', 'total ms', 'mean us'
+            )]
+        with self.lock:
+            items = sorted(self.stats.items())
+        for (model, field, operation), stats in items:
+            lines.append("%-40s %-10s %8d %12.3f %10.1f" % (
+                '%s.%s' % (model, field), operation, stats['count'],
+                stats['seconds'] * 1000,
+                stats['seconds'] * 1000000 / stats['count']
+                ))
+            for name in ('raw', 'stored'):
+                if stats[name]:
+                    lines.append("    %-7s bytes: %s" % (name, '  '.join(
+                        "<=%s: %d" % (_format_size(bucket), count)
+                        for bucket, count in sorted(stats[name].items())
+                        )))
+        return '\n'.join(lines) + '\n'
+
+def _format_size(size):
+    """
+    Returns a power of two number of bytes in short form, e.g. '4K'.
+    """
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size //= 1024
+    return '%dT' % size
@@ -0,0 +1,128 @@
+"""
+Sending the queries of read-only views to a replica database. Add the
+router (and, for the sticky window after writes, the middleware) to
+your settings:
+
+    DATABASE_ROUTERS = ['dj_utils.replicas.ReplicaRouter']
+    MIDDLEWARE_CLASSES = (
+        ...
+        'dj_utils.replicas.StickyPrimaryMiddleware',
+        )
+
+then decorate the views with use_replica (or give method_required
+replica=True). Reads inside the view go to the replica, writes still
+go to the primary, and once something has been written, reads go back
+to the primary too, so the view sees its own changes.
+"""
+import functools
+import threading
+
+from django.db import DEFAULT_DB_ALIAS
+
+# The name of the cookie that sends a client's reads to the primary,
+# for a while after it last wrote.
+COOKIE_NAME = 'dj_utils_primary'
+
+# The safe methods, requests with any other are taken to be writes.
+_SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+# The aliases reads can be pinned to, so the router knows to send
+# writes for objects read from them to the primary.
+_replica_aliases = set()
+
+# The state of the current thread: 'pins' is a stack of the aliases
+# reads are pinned to, and 'wrote' is True once something was written.
+_state = threading.local()
+
+class reading_from(object):
+    """
+    A context manager that sends the reads inside it to the given
+    database alias, until something is written. They nest, and are
+    local to the thread.
+    """
+    def __init__(self, alias='replica'):
+        self.alias = alias
+        _replica_aliases.add(alias)
+
+    def __enter__(self):
+        if not hasattr(_state, 'pins'):
+            _state.pins = []
+        _state.pins.append((self.alias, getattr(_state, 'wrote', False)))
+        _state.wrote = False
+        return self
+
+    def __exit__(self, *exc_info):
+        alias, wrote = _state.pins.pop()
+        _state.wrote = wrote or _state.wrote
+
+def use_replica(alias='replica'):
+    """
+    A parameterized decorator that sends the reads in a view to the
+    given replica, unless the client has the cookie set by the
+    StickyPrimaryMiddleware, because it wrote something recently, in
+    which case it reads from the primary, so it sees its changes.
+    The content of a streamed response is read after the view returns,
+    so goes to the primary.
+    """
+    def _decorator(function):
+        pin = reading_from(alias)
+
+        @functools.wraps(function)
+        def _wrapper(request, *args, **kws):
+            if COOKIE_NAME in request.COOKIES:
+                return function(request, *args, **kws)
+            with pin:
+                return function(request, *args, **kws)
+        return _wrapper
+    return _decorator
+
+class ReplicaRouter(object):
+    """
+    A database router that sends reads to the alias they're pinned to
+    by use_replica or reading_from, if any, and writes to the primary.
+    """
+    # The alias writes go to.
+    primary = DEFAULT_DB_ALIAS
+
+    def db_for_read(self, model, **hints):
+        pins = getattr(_state, 'pins', None)
+        if pins and not _state.wrote:
+            return pins[-1][0]
+        return None
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        instance = hints.get('instance')
+        if getattr(_state, 'pins', None) or (
+                instance is not None and
+                instance._state.db in _replica_aliases):
+            return self.primary
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Objects read from a replica are copies of the primary's.
+        databases = _replica_aliases | set([self.primary])
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+class StickyPrimaryMiddleware(object):
+    """
+    Sets a cookie on the response to any request that writes (or that
+    isn't a safe method), for REPLICA_STICKY_SECONDS (by default 5), so
+    the client's reads go to the primary until the replica has caught
+    up with its changes.
+    """
+    def __init__(self):
+        from django.conf import settings
+        self.seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+    def process_request(self, request):
+        _state.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_state, 'wrote', False) or \
+                request.method not in _SAFE_METHODS:
+            response.set_cookie(COOKIE_NAME, '1', max_age=self.seconds)
+        _state.wrote = False
+        return response
@@ -1,41 +1,152 @@
-import os, sys
+import os, sys, time
 
+# The resolved machine id, and how it was found (see timing_report).
 _id = None
+_resolution = None
+
 def environment():
     """Returns the machine id that this install is running on."""
-    global _id
+    global _id, _resolution
     if _id is None:
+        start = time.time()
+        source = None
+        searched = 0
         if 'DJANGO_MACHINE_ID' in os.environ:
             _id = os.environ['DJANGO_MACHINE_ID']
+            source = '$DJANGO_MACHINE_ID'
         else:
-            # Look in the current directory, then the user's home,
-            # then the python path.
-            paths = [".", os.path.expanduser("~")] + sys.path
-            for path in paths:
+            for path in search_path() + _fallback_path():
+                searched += 1
                 fn = os.path.join(path, '.machine_id')
                 if os.path.isfile(fn):
                     _id = open(fn).read().strip()
+                    source = fn
                     break
             else:
                 _id = 'development'
-                import textwrap
-                print '\n'.join(textwrap.wrap(textwrap.dedent("""
-                    Running as development server with machine id
-                    '%s'. You should set this explicitly. The best way
-                    is to set the DJANGO_MACHINE_ID environment
-                    variable (e.g. in the WSGI, shell or mod_python
-                    configuration). Alternatively create a file called
-                    '.machine_id' containing just the id. The
-                    '.machine_id' file can go in the CWD, in your home
-                    directory, or in sys.path: the environment
-                    variable setting takes priority, then the paths
-                    are searched in that order.
-                    """ % _id), 76))
+        _resolution = dict(
+            id=_id, source=source, searched=searched,
+            seconds=time.time() - start
+            )
+        if source is None:
+            _warn_development(_id)
     return _id
+_environment = environment
+
+def _warn_development(machine_id):
+    """Tells the user that no machine id has been set."""
+    import textwrap
+    sys.stderr.write('\n'.join(textwrap.wrap(textwrap.dedent("""
+        Running as development server with machine id
+        '%s'. You should set this explicitly. The best way
+        is to set the DJANGO_MACHINE_ID environment
+        variable (e.g. in the WSGI, shell or mod_python
+        configuration). Alternatively create a file called
+        '.machine_id' containing just the id. If the
+        DJANGO_MACHINE_ID_PATH environment variable is set,
+        the file is looked for in the directories it lists,
+        and nowhere else. Otherwise it can go in the CWD,
+        in your home directory, or in sys.path: the
+        environment variable setting takes priority, then
+        the paths are searched in that order, with the
+        python install and its site-packages last.
+        """ % machine_id).strip(), 76)) + '\n')
+
+def search_path():
+    """
+    Returns the directories searched for a '.machine_id' file. These
+    are the ones in the DJANGO_MACHINE_ID_PATH environment variable,
+    if it is set, otherwise the current directory, the user's home,
+    then the python path. Entries in the python path that are zip
+    files or eggs, or that are part of the python install or its
+    installed packages, are skipped, since they are numerous (and may
+    be on slow filesystems), and are no place for a machine id. (The
+    install and packages are still searched if the file isn't found
+    anywhere else, see _fallback_path.)
+    """
+    if 'DJANGO_MACHINE_ID_PATH' in os.environ:
+        return [
+            path for path in
+            os.environ['DJANGO_MACHINE_ID_PATH'].split(os.pathsep) if path
+            ]
+    paths = [".", os.path.expanduser("~")]
+    for path in sys.path:
+        if _is_library(path) is False and path not in paths:
+            paths.append(path)
+    return paths
+
+def _fallback_path():
+    """
+    Returns the directories in the python path that are part of the
+    python install or its installed packages, which are searched last,
+    for compatibility with projects that keep their '.machine_id' there.
+    """
+    if 'DJANGO_MACHINE_ID_PATH' in os.environ:
+        return []
+    paths = []
+    for path in sys.path:
+        if _is_library(path) and path not in paths:
+            paths.append(path)
+    return paths
+
+def _is_library(path):
+    """
+    Returns True if the python path entry is part of the python install
+    or its installed packages, None if it is a zip file or egg (which
+    can't hold a '.machine_id'), otherwise False.
+    """
+    if path.endswith(('.zip', '.egg')):
+        return None
+    library = tuple(set(
+        os.path.join(os.path.abspath(prefix), 'lib') + os.sep
+        for prefix in (sys.prefix, sys.exec_prefix)
+        ))
+    full_path = os.path.abspath(path or '.')
+    parts = full_path.split(os.sep)
+    return 'site-packages' in parts or 'dist-packages' in parts or \
+        (full_path + os.sep).startswith(library)
 
-def config(default=None, environment=environment(), **values):
+def set_environment(machine_id):
+    """Overrides the machine id (e.g. in tests)."""
+    global _id, _resolution
+    _id = machine_id
+    _resolution = dict(id=machine_id, source='set_environment',
+                       searched=0, seconds=0.0)
+
+def reset_environment():
+    """Forgets the machine id, so it is found again when next needed."""
+    global _id, _resolution
+    _id = None
+    _resolution = None
+
+def timing_report():
+    """Describes how the machine id was found, and how long it took."""
+    if _resolution is None:
+        return "Machine id not resolved yet."
+    return "Machine id '%s' from %s in %.2fms (%d paths searched)." % (
+        _resolution['id'], _resolution['source'] or 'the default',
+        _resolution['seconds'] * 1000, _resolution['searched']
+        )
+
+def config(default=None, environment=None, **values):
     """Pick a specific configuration value for a specific environment."""
+    if environment is None:
+        environment = _environment()
     if environment in values:
         return values[environment]
     else:
         return default
+
+def lazy_config(default=None, **values):
+    """
+    Like config, but the value is only picked when it is first used,
+    so the machine id isn't needed while the settings are loaded. The
+    result is a lazy proxy, so this is for string values, such as
+    paths and URLs.
+    """
+    from django.utils.functional import lazy
+    types = set(
+        type(value) for value in [default] + values.values()
+        if isinstance(value, basestring)
+        )
+    return lazy(lambda: config(default, **values), *(types or [str]))()
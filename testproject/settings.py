@@ -17,9 +17,18 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+    },
+    # A stand-in for a read replica. It isn't a TEST_MIRROR of the
+    # default, so in tests it is an empty database of its own, and
+    # reads that are routed to it can be told apart.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.db',
     }
 }
 
+DATABASE_ROUTERS = ['dj_utils.replicas.ReplicaRouter']
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -98,6 +107,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'dj_utils.replicas.StickyPrimaryMiddleware',
 )
 
 ROOT_URLCONF = 'testproject.urls'
@@ -0,0 +1,462 @@
+"""
+Benchmarks for the hot paths in dj_utils. These are run with the
+'benchmark' management command, e.g.
+
+    $ python manage.py benchmark slugify
+
+Each benchmark is a function that takes the requested scale (a number
+of rows or iterations) and returns a dictionary of named timings in
+seconds (as floats), along with any other figures worth reporting.
+Benchmarks that use the database are run against a test database,
+created by the command.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import subprocess
+
+from django.template.defaultfilters import slugify
+
+from dj_utils import choices, decorators, encoders, metrics, replicas
+from dj_utils.fields import ido, json_field, pickle_field, slug
+
+# The registry of benchmarks, in the order they are run.
+BENCHMARKS = []
+
+def benchmark(default_scale, database=False):
+    """
+    A parameterized decorator that registers a benchmark function,
+    with the scale it runs at when no other is given, and whether it
+    needs a database.
+    """
+    def _decorator(function):
+        function.default_scale = default_scale
+        function.database = database
+        BENCHMARKS.append(function)
+        return function
+    return _decorator
+
+def timed(function, *args, **kws):
+    """
+    Calls the given function and returns a tuple of its result and the
+    number of seconds it took.
+    """
+    start = time.time()
+    result = function(*args, **kws)
+    return result, time.time() - start
+
+_words = [
+    u'The', u'quick', u'brown', u'fox', u'Caf\xe9', u'na\xefve',
+    u'\xdcber', u'r\xe9sum\xe9', u'2013', u'edition', u'--', u'&',
+    u'Vol.', u'III', u'(Remastered)', u'A/B', u'50%', u'off!'
+    ]
+
+def make_titles(count, seed=1):
+    """
+    Returns a list of random catalog-like titles, with a mix of
+    punctuation and accented characters.
+    """
+    rnd = random.Random(seed)
+    return [
+        u' '.join(rnd.choice(_words) for i in range(rnd.randint(1, 8)))
+        for i in xrange(count)
+        ]
+
+@benchmark(1000000)
+def bench_slugify(count):
+    """
+    Converts titles into restricted slugs, comparing the batch
+    function against django's slugify plus regex cleanup.
+    """
+    titles = make_titles(count)
+
+    double_hyphen = re.compile('-{2,}')
+    invalid = re.compile('[^a-z0-9-]')
+    def cleanup(title):
+        value = invalid.sub('-', slugify(title))
+        return double_hyphen.sub('-', value).strip('-')
+
+    reference, reference_time = timed(lambda: [cleanup(t) for t in titles])
+    single, single_time = timed(
+        lambda: [slug.restricted_slugify(t) for t in titles]
+        )
+    many, many_time = timed(slug.restricted_slugify_many, titles)
+
+    invalid_count = sum(
+        1 for value in many
+        if value is not None and not slug.restricted_slug_re.match(value)
+        )
+    return dict(
+        django_slugify=reference_time,
+        restricted_slugify=single_time,
+        restricted_slugify_many=many_time,
+        invalid=invalid_count
+        )
+
+@benchmark(100000)
+def bench_ido(count):
+    """
+    Obfuscates 'count' sequential ids, as numbers and as codes.
+    """
+    obfuscator = ido.IdObfuscator.create_from_seed(
+        35, "f2edbc65-8064-40b8-a0b3-d6579246b37d"
+        )
+    ids = xrange(1, count + 1)
+    results = {}
+    results['ido_value'] = timed(
+        lambda: [obfuscator.get_obfuscated_id_value(i) for i in ids]
+        )[1]
+    results['ido_code'] = timed(
+        lambda: [obfuscator.get_obfuscated_id(i) for i in ids]
+        )[1]
+    return results
+
+# The payloads stored by the field benchmarks, by size.
+def _payloads():
+    return [
+        ('small', dict(id=1, title=u'Caf\xe9', tags=[u'a', u'b'])),
+        ('medium', dict(photos=make_photos(20))),
+        ('large', dict(photos=make_photos(1000))),
+        ]
+
+@benchmark(1000)
+def bench_fields(count):
+    """
+    Encodes and decodes small, medium and large values with the json
+    and pickle fields, the medium ones 'count' times (and the small
+    and large ones 10 times more and less).
+    """
+    fields = [
+        ('json', json_field.JSONField()),
+        ('pickle', pickle_field.PickledObjectField()),
+        ('pickle_compressed', pickle_field.PickledObjectField(compress=True))
+        ]
+    results = {}
+    for size, value in _payloads():
+        repeat = dict(small=count * 10, medium=count, large=count // 10)[size]
+        repeat = xrange(max(repeat, 1))
+        for name, field in fields:
+            stored, seconds = timed(
+                lambda: [field.get_db_prep_value(value) for i in repeat][-1]
+                )
+            results['%s_%s_encode' % (name, size)] = seconds
+            results['%s_%s_decode' % (name, size)] = timed(
+                lambda: [field.to_python(stored) for i in repeat]
+                )[1]
+            results['%s_%s_bytes' % (name, size)] = len(stored)
+    return results
+
+@benchmark(1000)
+def bench_metrics(count):
+    """
+    Encodes and decodes the medium payload 'count' times with the
+    fields of the test model, with metrics disabled, then enabled, to
+    show what recording them costs.
+    """
+    from testapp import models
+    value = _payloads()[1][1]
+    repeat = xrange(count)
+    results = {}
+    for name in ('json_data', 'pickle_data'):
+        field = models.TestModel._meta.get_field(name)
+        stored = field.get_db_prep_value(value)
+        for state in ('disabled', 'enabled'):
+            if state == 'enabled':
+                metrics.enable()
+            try:
+                results['%s_encode_%s' % (name, state)] = timed(
+                    lambda: [field.get_db_prep_value(value) for i in repeat]
+                    )[1]
+                results['%s_decode_%s' % (name, state)] = timed(
+                    lambda: [field.to_python(stored) for i in repeat]
+                    )[1]
+            finally:
+                metrics.disable()
+    return results
+
+@benchmark(100000)
+def bench_replicas(count):
+    """
+    Picks the database for 'count' querysets, with reads unpinned and
+    pinned to the replica, to show what the routing costs.
+    """
+    from testapp import models
+    repeat = xrange(count)
+    def pick():
+        return [models.TestModel.objects.all().db for i in repeat][-1]
+    unpinned, unpinned_time = timed(pick)
+    with replicas.reading_from('replica'):
+        pinned, pinned_time = timed(pick)
+    return dict(
+        unpinned=unpinned_time, pinned=pinned_time,
+        databases='%s, %s' % (unpinned, pinned)
+        )
+
+# The program that times an import in a new interpreter (once django's
+# models are loaded, since any project will have those anyway), and
+# prints the seconds it took and the number of modules it loaded.
+_import_timer = """
+import sys, time
+import django.db.models
+modules = len(sys.modules)
+start = time.time()
+%s
+print time.time() - start, len(sys.modules) - modules
+"""
+
+@benchmark(5)
+def bench_imports(count):
+    """
+    Imports a single field module, and all of them, each in a new
+    interpreter, taking the fastest of 'count' runs.
+    """
+    statements = [
+        ('uuid_field', 'from dj_utils.fields import uuid_field'),
+        ('all_fields', 'from dj_utils.fields import '
+                       'ido, uuid, json, pickle, password, slug'),
+        ]
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(sys.path)
+    results = {}
+    for name, statement in statements:
+        runs = []
+        for i in range(count):
+            output = subprocess.Popen(
+                [sys.executable, '-c', _import_timer % statement],
+                stdout=subprocess.PIPE, env=environment
+                ).communicate()[0]
+            seconds, modules = output.split()
+            runs.append(float(seconds))
+        results[name] = min(runs)
+        results[name + '_modules'] = int(modules)
+    return results
+
+@benchmark(20)
+def bench_json_iter(count):
+    """
+    Reads the first 50 of 50000 events stored in a json field, and
+    then all of them, comparing iter_decode with decoding the value.
+    """
+    import itertools
+    stored = json_field.dbsafe_encode(dict(events=make_photos(50000)))
+    def first_page():
+        return list(itertools.islice(
+            json_field.iter_decode(stored, 'events'), 50
+            ))
+
+    results = {}
+    results['decode_first_page'] = timed(
+        lambda: [json_field.dbsafe_decode(stored)['events'][:50]
+                 for i in xrange(count)]
+        )[1]
+    results['iter_first_page'] = timed(
+        lambda: [first_page() for i in xrange(count)]
+        )[1]
+    results['iter_all'] = timed(
+        lambda: [list(json_field.iter_decode(stored, 'events'))
+                 for i in xrange(count)]
+        )[1]
+    return results
+
+@benchmark(1000000)
+def bench_choices(count):
+    """
+    Looks up a choice value by name, comparing Choices with its
+    compiled form.
+    """
+    plain = choices.Choices(
+        (0, 'PRIVATE', 'Private'),
+        (1, 'FRIENDS', 'Show friends'),
+        (2, 'PUBLIC', 'Show everyone')
+        )
+    compiled = plain.compile()
+
+    def lookup(target):
+        for i in xrange(count):
+            target.PUBLIC
+    results = {}
+    results['choices_attribute'] = timed(lookup, plain)[1]
+    results['compiled_attribute'] = timed(lookup, compiled)[1]
+    return results
+
+def make_photos(count, seed=1):
+    """
+    Returns a list of photo-like dictionaries, the typical shape of a
+    json_response list endpoint.
+    """
+    rnd = random.Random(seed)
+    titles = make_titles(count, seed)
+    return [
+        dict(
+            id=i, title=title, owner=dict(id=rnd.randint(1, 500), name=u'jo'),
+            width=rnd.randint(100, 4000), height=rnd.randint(100, 4000),
+            rating=rnd.random() * 5, public=rnd.random() > 0.2,
+            tags=[u'tag%d' % rnd.randint(1, 50) for t in range(3)]
+            )
+        for i, title in enumerate(titles)
+        ]
+
+@benchmark(100)
+def bench_encoders(count):
+    """
+    Encodes a page of 1000 photos 'count' times in each of the
+    response encodings, reporting the time and the encoded size.
+    """
+    data = dict(ok=True, photos=make_photos(1000))
+    results = {}
+    seen = set()
+    for encoding in encoders._encodings:
+        if encoding.encode in seen:
+            continue
+        seen.add(encoding.encode)
+        name = encoding.content_type.split('/')[-1].replace('-', '_')
+        content, seconds = timed(
+            lambda: [encoding.encode(data) for i in xrange(count)][-1]
+            )
+        results[name] = seconds
+        results[name + '_bytes'] = len(content)
+    return results
+
+@benchmark(100)
+def bench_shapes(count):
+    """
+    Encodes a page of 1000 rows 'count' times, comparing the
+    shape-specialized row writers against the json module, both for
+    dictionaries (as streamed) and for tuples from values_list.
+    """
+    keys = ('id', 'title', 'width', 'rating', 'public')
+    photos = make_photos(1000)
+    rows = [tuple(photo[key] for key in keys) for photo in photos]
+    flat = [dict(zip(keys, row)) for row in rows]
+
+    def per_row(dicts):
+        return '[' + ', '.join([json.dumps(row) for row in dicts]) + ']'
+    def generic_values(rows):
+        template = encoders._row_template(keys)
+        writers = encoders._value_writers
+        return [
+            template % tuple([writers[type(value)](value) for value in row])
+            for row in rows
+            ]
+    def shaped_values(rows):
+        encode_values = encoders.RowEncoder(keys).encode_values
+        return [encode_values(row) for row in rows]
+
+    def shaped(dicts):
+        return encoders.ShapeEncoder().encode_rows(dicts)
+
+    results = {}
+    for name, function, data in [
+            ('json_flat_rows', per_row, flat),
+            ('shaped_flat_rows', shaped, flat),
+            ('json_nested_rows', per_row, photos),
+            ('shaped_nested_rows', shaped, photos),
+            ('generic_values', generic_values, rows),
+            ('shaped_values', shaped_values, rows),
+            ]:
+        results[name] = timed(
+            lambda: [function(data) for i in xrange(count)]
+            )[1]
+    return results
+
+@benchmark(2000)
+def bench_template_cache(count):
+    """
+    Renders a page 'count' times, with and without the rendered html
+    cached by its version key. Both fill in a per-request fragment.
+    """
+    from django.test.client import RequestFactory
+
+    message = u' '.join(make_titles(50))
+    def fragment(request):
+        return u'<b>%s</b>' % request.GET.get('name', '')
+    def view(request):
+        return dict(message=message)
+    plain = decorators.template_response(
+        'testapp/cached.html', fragments=dict(greeting=fragment)
+        )(view)
+    cached = decorators.template_response(
+        'testapp/cached.html', fragments=dict(greeting=fragment),
+        cache_key=lambda request: 'version-1'
+        )(view)
+
+    request = RequestFactory().get('/', dict(name='jo'))
+    results = {}
+    for name, function in [('render', plain), ('cached', cached)]:
+        results[name] = timed(
+            lambda: [function(request) for i in xrange(count)]
+            )[1]
+    return results
+
+@benchmark(2000, database=True)
+def bench_uuid_inserts(count):
+    """
+    Inserts 'count' rows with a UUIDField (and the model's other
+    fields) one at a time, and then in bulk.
+    """
+    from django.db import transaction
+    from testapp import models
+
+    def insert():
+        with transaction.commit_on_success():
+            for i in xrange(count):
+                models.TestModel.objects.create()
+    def bulk_insert():
+        with transaction.commit_on_success():
+            models.TestModel.objects.bulk_create([
+                models.TestModel() for i in xrange(count)
+                ])
+
+    results = {}
+    results['uuid_save'] = timed(insert)[1]
+    results['uuid_bulk_create'] = timed(bulk_insert)[1]
+    results['duplicates'] = count * 2 - len(set(
+        models.TestModel.objects.values_list('uuid', flat=True)
+        ))
+    models.TestModel.objects.all().delete()
+    return results
+
+@benchmark(2000, database=True)
+def bench_responses(count):
+    """
+    Handles 'count' requests with json_response and template_response
+    views, each returning 20 photos from memory and 20 model instances
+    from the database.
+    """
+    from django.test.client import RequestFactory
+    from testapp import models
+
+    models.TestModel.objects.bulk_create([
+        models.TestModel(json_data=dict(i=i)) for i in range(20)
+        ])
+    photos = make_photos(20)
+
+    @decorators.json_response()
+    def json_photos(request):
+        return dict(photos=photos)
+    @decorators.json_response(stream=True)
+    def json_models(request):
+        return dict(models=models.TestModel.objects.values('id', 'uuid'))
+    @decorators.json_response(project=dict(models=('id', 'uuid')))
+    def json_projected(request):
+        return dict(models=models.TestModel.objects.all())
+    @decorators.template_response('testapp/message.html')
+    def template_photos(request):
+        return dict(message=photos)
+
+    request = RequestFactory().get('/')
+    results = {}
+    for name, view in [
+            ('json_response', json_photos),
+            ('json_response_stream', json_models),
+            ('json_response_project', json_projected),
+            ('template_response', template_photos)
+            ]:
+        results[name] = timed(
+            lambda: [''.join(view(request)) for i in xrange(count)]
+            )[1]
+    models.TestModel.objects.all().delete()
+    return results
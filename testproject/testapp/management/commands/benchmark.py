@@ -0,0 +1,130 @@
+import sys
+import json
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+from testapp import benchmarks
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = 'Runs the dj_utils benchmarks (all of them, by default).'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--scale', type='int', dest='scale', default=None,
+            help='Override the number of rows or iterations to use.'
+            ),
+        make_option(
+            '--save', dest='save', default=None,
+            help='Save the results as a json baseline in this file.'
+            ),
+        make_option(
+            '--compare', dest='compare', default=None,
+            help='Compare the timings with the baseline in this file, '
+                 'and fail if any are slower than the tolerance allows.'
+            ),
+        make_option(
+            '--repeat', type='int', dest='repeat', default=5,
+            help='Run each benchmark this many times, and keep the best '
+                 'of each timing (default 5).'
+            ),
+        make_option(
+            '--tolerance', type='float', dest='tolerance', default=0.2,
+            help='The fraction a timing can be slower than the baseline '
+                 'before it counts as a regression (default 0.2).'
+            ),
+        )
+
+    def handle(self, *names, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1.")
+        available = dict(
+            (function.__name__[len('bench_'):], function)
+            for function in benchmarks.BENCHMARKS
+            )
+        for name in names:
+            if name not in available:
+                raise CommandError("No such benchmark: '%s'" % name)
+        selected = [
+            function for function in benchmarks.BENCHMARKS
+            if not names or function.__name__[len('bench_'):] in names
+            ]
+
+        baseline = {}
+        if options['compare']:
+            try:
+                with open(options['compare']) as source:
+                    baseline = json.load(source)['benchmarks']
+            except (IOError, ValueError, KeyError), err:
+                raise CommandError("Can't read baseline: %s" % err)
+
+        # Benchmarks that use models get a test database of their own.
+        connection = old_name = None
+        if any(function.database for function in selected):
+            from django.db import connection
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0)
+        try:
+            results, regressions = self.run(selected, baseline, options)
+        finally:
+            if connection is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save']:
+            with open(options['save'], 'w') as out:
+                json.dump(dict(
+                    python=sys.version.split()[0],
+                    django=django.get_version(),
+                    benchmarks=results
+                    ), out, indent=2, sort_keys=True)
+        if regressions:
+            raise CommandError(
+                "%d timings regressed by more than %d%%: %s" % (
+                    len(regressions), options['tolerance'] * 100,
+                    ', '.join(regressions)
+                    )
+                )
+
+    def run(self, selected, baseline, options):
+        """
+        Runs and reports the given benchmarks, returning their results,
+        and the names of any timings that regressed from the baseline.
+        Each benchmark is run 'repeat' times, and the fastest of each
+        timing is kept, since the slower ones only measure noise.
+        """
+        results = {}
+        regressions = []
+        for function in selected:
+            name = function.__name__[len('bench_'):]
+            scale = options['scale'] or function.default_scale
+            self.stdout.write("%s (%d):\n" % (name, scale))
+            figures = function(scale)
+            for attempt in range(options['repeat'] - 1):
+                for key, value in function(scale).items():
+                    if isinstance(value, float):
+                        value = min(value, figures[key])
+                    figures[key] = value
+            results[name] = dict(scale=scale, results=figures)
+
+            # Only compare with a baseline run at the same scale.
+            previous = baseline.get(name)
+            if previous is not None and previous['scale'] != scale:
+                self.stdout.write("    (baseline scale differs)\n")
+                previous = None
+            previous = previous and previous['results'] or {}
+
+            for key, value in sorted(figures.items()):
+                if not isinstance(value, float):
+                    self.stdout.write("    %-30s %10s\n" % (key, value))
+                    continue
+                line = "    %-30s %10.4fs" % (key, value)
+                old = previous.get(key)
+                if old:
+                    change = value / old - 1
+                    line += "  %+7.1f%%" % (change * 100)
+                    if change > options['tolerance']:
+                        line += "  REGRESSION"
+                        regressions.append('%s.%s' % (name, key))
+                self.stdout.write(line + "\n")
+        return results, regressions
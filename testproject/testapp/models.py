@@ -1,12 +1,22 @@
 from django.db import models
 
 import dj_utils.fields as dj_fields
+from dj_utils import choices
+
+PRIVACY_CHOICES = choices.Choices(
+    (0, 'PRIVATE', 'Private', dict(icon='lock', shared=False)),
+    (1, 'FRIENDS', 'Show friends', dict(shared=True)),
+    (2, 'PUBLIC', 'Show everyone', dict(icon='globe', shared=True))
+    )
 
 class TestModel(models.Model):
     json_data = dj_fields.json.JSONField()
     pickle_data = dj_fields.pickle.PickledObjectField()
     uuid = dj_fields.uuid.UUIDField()
     restricted_slug = dj_fields.slug.RestrictedSlugField()
+    privacy = models.IntegerField(
+        choices=PRIVACY_CHOICES, default=PRIVACY_CHOICES.PRIVATE
+        )
     ido = dj_fields.ido.ObfuscatedIdField(
         bits = 30,
         seed = "f2edbc65-8064-40b8-a0b3-d6579246b37d"
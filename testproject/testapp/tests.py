@@ -1,6 +1,25 @@
+import os
+import sys
+import copy
+import json
+import zlib
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import itertools
+import subprocess
+
+import django.http as http
 from django.test import TestCase
+from django.test.client import RequestFactory
 
 import models
+import views
+from dj_utils import choices, decorators, encoders, metrics, replicas
+from dj_utils import settings_utils
+from dj_utils.fields import json_field, slug
 
 class TestPickleField(TestCase):
     def test_default(self):
@@ -35,3 +54,1082 @@ class TestJSONField(TestCase):
         m.save()
         m = models.TestModel.objects.get(pk=m.id)
         self.assertEqual(m.get_json_data_json(), '{"foo": 1}')
+
+    def test_iter(self):
+        events = [dict(id=i, value=i * 0.5) for i in range(1000)]
+        m = models.TestModel(json_data=dict(pages=[dict(events=events)]))
+        m.save()
+        m = models.TestModel.objects.defer('json_data').get(pk=m.id)
+        items = m.iter_json_data(['pages', 0, 'events'])
+        self.assertEqual(list(itertools.islice(items, 3)), events[:3])
+        self.assertRaises(KeyError, m.iter_json_data, 'missing')
+        self.assertRaises(ValueError, m.iter_json_data, ['pages', 0])
+
+        m = models.TestModel.objects.get(pk=m.id)
+        items = m.iter_json_data(('pages', 0, 'events'))
+        self.assertEqual(list(items), events)
+
+    def test_iter_decode(self):
+        # Tiny chunks split the numbers and strings.
+        value = [0.125, u'a"\u2014', [1, {}], None, 12345678, {'b': [True]}]
+        encoded = json_field.dbsafe_encode(dict(a=[1, 2], b=value))
+        self.assertEqual(
+            list(json_field.iter_decode(encoded, 'b', chunk_size=3)), value
+            )
+
+class TestLazyFields(TestCase):
+    def test_aliases(self):
+        import dj_utils.fields as fields
+        self.assertTrue(fields.slug is slug)
+        field = models.TestModel._meta.get_field('uuid')
+        self.assertTrue(isinstance(field, fields.uuid.UUIDField))
+        self.assertRaises(AttributeError, getattr, fields, 'missing')
+
+    def test_lazy_import(self):
+        # The auth app is only imported for the password field.
+        program = (
+            'import sys, django.db.models\n'
+            'from dj_utils.fields import uuid_field\n'
+            'print "django.contrib.auth.models" in sys.modules\n'
+            )
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen(
+            [sys.executable, '-c', program],
+            stdout=subprocess.PIPE, env=environment
+            ).communicate()[0]
+        self.assertEqual(output.strip(), 'False')
+
+class TestRestrictedSlugify(TestCase):
+    def test_slugify(self):
+        self.assertEqual(
+            slug.restricted_slugify(u'  The Caf\xe9 -- Vol. 2! '),
+            'the-cafe-vol-2'
+            )
+
+    def test_valid(self):
+        for text in (u'--a--', u'A_B', u'\u2014x\u2014y', u'50% off!'):
+            value = slug.restricted_slugify(text)
+            self.assertTrue(slug.restricted_slug_re.match(value), value)
+
+    def test_max_length(self):
+        self.assertEqual(
+            slug.restricted_slugify('abc def', max_length=4), 'abc'
+            )
+
+    def test_default(self):
+        self.assertEqual(slug.restricted_slugify(u'!?', default='x'), 'x')
+        self.assertEqual(slug.restricted_slugify(None, default='x'), 'x')
+        self.assertEqual(
+            slug.restricted_slugify_many([u'Foo', None], default='x'),
+            ['foo', 'x']
+            )
+
+    def test_many(self):
+        self.assertEqual(
+            slug.restricted_slugify_many(['Foo Bar', u'\xdcber', '']),
+            ['foo-bar', 'uber', None]
+            )
+
+class TestCompiledChoices(TestCase):
+    def setUp(self):
+        self.choices = choices.Choices(
+            (0, 'PRIVATE', 'Private', dict(icon='lock')),
+            (1, 'FRIENDS', 'Show friends'),
+            (2, 'PUBLIC', 'Show everyone', dict(icon='globe'))
+            )
+        self.compiled = self.choices.compile()
+
+    def test_attributes(self):
+        self.assertEqual(self.compiled.PUBLIC, 2)
+        self.assertTrue('PUBLIC' in type(self.compiled).__dict__)
+        self.assertFalse(hasattr(self.compiled, '__dict__'))
+        self.assertRaises(AttributeError, getattr, self.compiled, 'OTHER')
+
+    def test_lookups(self):
+        self.assertEqual(list(self.compiled), list(self.choices))
+        self.assertEqual(len(self.compiled), 3)
+        self.assertEqual(self.compiled[1], 'Show friends')
+        self.assertEqual(self.compiled.value_to_data(0, 'icon'), 'lock')
+        self.assertEqual(self.compiled.data_to_value('icon', 'globe'), 2)
+        self.assertEqual(self.compiled.data_to_value('size', 'big'), None)
+
+    def test_inherit(self):
+        extended = choices.compile_choices(
+            (3, 'SECRET', 'Secret'), inherit=self.compiled
+            )
+        self.assertEqual(extended.SECRET, 3)
+        self.assertEqual(extended.PRIVATE, 0)
+
+    def test_reserved_name(self):
+        bad = choices.Choices((0, 'value_to_string', 'Value'))
+        self.assertRaises(ValueError, bad.compile)
+
+class TestChoicesDisplay(TestCase):
+    def setUp(self):
+        for privacy in (0, 1, 2):
+            models.TestModel.objects.create(privacy=privacy)
+
+    def test_display(self):
+        queryset = models.PRIVACY_CHOICES.annotate_display(
+            models.TestModel.objects.order_by('privacy'), 'privacy'
+            )
+        self.assertEqual(
+            list(queryset.values_list('privacy_display', flat=True)),
+            [u'Private', u'Show friends', u'Show everyone']
+            )
+
+    def test_data(self):
+        queryset = models.PRIVACY_CHOICES.compile().annotate_display(
+            models.TestModel.objects.order_by('privacy'), 'privacy',
+            alias='icon', data_type='icon', default='none'
+            )
+        self.assertEqual(
+            [row['icon'] for row in queryset.values('icon')],
+            [u'lock', u'none', u'globe']
+            )
+
+    def test_numeric_data(self):
+        sizes = choices.Choices(
+            (0, 'SMALL', 'Small', dict(scale=0.5, shared=False)),
+            (1, 'LARGE', 'Large', dict(scale=2.0, shared=True)),
+            )
+        for data_type, expected in (
+                ('scale', [0.5, 2.0]), ('shared', [False, True])
+                ):
+            sql, params = sizes.display_sql('x', data_type)
+            self.assertEqual(params[1::2], expected)
+            self.assertEqual(
+                [type(param) for param in params[1::2]],
+                [type(value) for value in expected]
+                )
+
+def has_icon(data):
+    return 'icon' in data
+
+class TestChoicesFilters(TestCase):
+    def setUp(self):
+        for privacy in (0, 1, 2):
+            models.TestModel.objects.create(privacy=privacy)
+
+    def test_values(self):
+        compiled = models.PRIVACY_CHOICES.compile()
+        for target in (models.PRIVACY_CHOICES, compiled):
+            self.assertEqual(
+                target.values_with('shared', True), frozenset([1, 2])
+                )
+            self.assertEqual(target.values_with('size', 1), frozenset())
+            self.assertEqual(target.values_where(has_icon), frozenset([0, 2]))
+            self.assertTrue(has_icon in target._predicate_cache)
+
+    def test_filter(self):
+        q = models.PRIVACY_CHOICES.filter_q('privacy', 'shared', False)
+        self.assertEqual(
+            [m.privacy for m in models.TestModel.objects.filter(q)], [0]
+            )
+        q = models.PRIVACY_CHOICES.filter_q('privacy', predicate=has_icon)
+        self.assertEqual(
+            models.TestModel.objects.filter(q).count(), 2
+            )
+        self.assertRaises(
+            TypeError, models.PRIVACY_CHOICES.filter_q, 'privacy'
+            )
+
+    def test_copy(self):
+        models.PRIVACY_CHOICES.values_where(has_icon)
+        choices = copy.deepcopy(models.PRIVACY_CHOICES)
+        self.assertEqual(choices.values_where(has_icon), frozenset([0, 2]))
+        self.assertEqual(choices.PRIVATE, models.PRIVACY_CHOICES.PRIVATE)
+
+    def test_predicate_cache(self):
+        choices = models.PRIVACY_CHOICES.compile()
+        for i in range(1000):
+            choices.values_where(lambda data: data.get('shared') is i)
+        self.assertEqual(len(choices._predicate_cache), 32)
+
+class TestStreamingJSON(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        for privacy in (2, 1):
+            models.TestModel.objects.create(privacy=privacy)
+
+    def test_stream(self):
+        response = views.stream_models(self.factory.get('/'))
+        data = json.loads(''.join(response))
+        self.assertEqual([m['privacy'] for m in data['models']], [2, 1])
+        self.assertEqual(data['count'], [0, 1, 4])
+        self.assertEqual(data['ok'], True)
+
+    def test_jsonp(self):
+        response = views.stream_models(
+            self.factory.get('/', dict(callback='cb'))
+            )
+        content = ''.join(response)
+        self.assertTrue(content.startswith('cb({'))
+        self.assertTrue(content.endswith('});'))
+
+    def test_html(self):
+        response = views.stream_models(
+            self.factory.get('/', dict(format='html'))
+            )
+        self.assertTrue("<div class='number'>4</div>" in response.content)
+
+class TestHTMLOutput(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_limits(self):
+        @decorators.json_response(html_max_items=4, html_max_depth=2)
+        def view(request):
+            return dict(numbers=range(6), nested=[[[1]]], text='<b>')
+        content = view(self.factory.get('/', dict(format='html'))).content
+        self.assertTrue('<p>2 more items</p>' in content)
+        self.assertTrue("<div class='array'><p>1 items</p></div>" in content)
+        self.assertTrue('"&lt;b&gt;"' in content)
+        self.assertFalse("<div class='number'>4</div>" in content)
+
+    def test_byte_strings(self):
+        @decorators.json_response()
+        def view(request):
+            return {'name': 'caf\xc3\xa9', 'k\xc3\xa9': ['<\xc3\xa9>']}
+        response = view(self.factory.get('/', dict(format='html')))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertTrue(u'"caf\xe9"' in content)
+        self.assertTrue(u'k\xe9:' in content)
+        self.assertTrue(u'"&lt;\xe9&gt;"' in content)
+
+    def test_iterables(self):
+        models.TestModel.objects.create(privacy=2)
+        @decorators.json_response()
+        def view(request):
+            return dict(
+                squares=(i * i for i in range(3)),
+                models=models.TestModel.objects.values('privacy')
+                )
+        content = view(self.factory.get('/', dict(format='html'))).content
+        self.assertFalse('generator object' in content)
+        self.assertTrue("<div class='number'>4</div>" in content)
+        self.assertTrue("privacy:</th><td><div class='number'>2" in content)
+
+    def test_static_data(self):
+        @decorators.json_response(
+            title='x', static_data=dict(project='y', stream='z')
+            )
+        def view(request):
+            return dict()
+        self.assertEqual(
+            json.loads(view(self.factory.get('/')).content),
+            dict(ok=True, title='x', project='y', stream='z')
+            )
+        self.assertRaises(TypeError, decorators.json_response, project='y')
+        self.assertRaises(
+            TypeError, decorators.template_response, 'testapp/message.html',
+            fragments=['a']
+            )
+
+    def test_deep(self):
+        deep = node = []
+        for i in range(5000):
+            node.append([])
+            node = node[0]
+        html = decorators._JSONToHTML().render('/', dict(deep=deep))
+        self.assertEqual(html.count('<table>'), 5001)
+
+class TestConditionalGET(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_json_etag(self):
+        response = views.message(self.factory.get('/'))
+        etag = response['ETag']
+        response = views.message(
+            self.factory.get('/', HTTP_IF_NONE_MATCH=etag)
+            )
+        self.assertEqual(response.status_code, 304)
+        response = views.message(
+            self.factory.get('/', dict(message='x'), HTTP_IF_NONE_MATCH=etag)
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_version_key(self):
+        response = views.versioned_message(self.factory.get('/?version=1'))
+        etag = response['ETag']
+        calls = views.versioned_message.calls
+        response = views.versioned_message(
+            self.factory.get('/?version=1', HTTP_IF_NONE_MATCH=etag)
+            )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(views.versioned_message.calls, calls)
+        request = self.factory.get(
+            '/?version=1&callback=cb', HTTP_IF_NONE_MATCH=etag
+            )
+        response = views.versioned_message(request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_template_etag(self):
+        response = views.message_page(self.factory.get('/'))
+        self.assertEqual(response.content, '<p>hello</p>\n')
+        response = views.message_page(
+            self.factory.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+            )
+        self.assertEqual(response.status_code, 304)
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        views.cached_message.cache_stats.reset()
+
+    def test_cache(self):
+        first = views.cached_message(self.factory.get('/?message=a'))
+        calls = views.cached_message.calls
+        second = views.cached_message(self.factory.get('/?message=a'))
+        self.assertEqual(views.cached_message.calls, calls)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Content-Type'], 'application/json')
+        self.assertEqual(
+            views.cached_message.cache_stats.as_dict(),
+            dict(hits=1, misses=1)
+            )
+
+    def test_variants(self):
+        plain = views.cached_message(self.factory.get('/?message=b'))
+        jsonp = views.cached_message(
+            self.factory.get('/?message=b&callback=cb')
+            )
+        self.assertNotEqual(plain.content, jsonp.content)
+        self.assertEqual(views.cached_message.cache_stats['hits'], 0)
+
+    def test_template(self):
+        first = views.cached_page(self.factory.get('/?version=1&name=a'))
+        calls = views.cached_page.calls
+        second = views.cached_page(self.factory.get('/?version=1&name=b'))
+        self.assertEqual(views.cached_page.calls, calls)
+        self.assertEqual(
+            first.content.replace('<b>hi a</b>', '<b>hi b</b>'),
+            second.content
+            )
+        self.assertFalse('dj_utils.fragment' in second.content)
+
+        views.cached_page(self.factory.get('/?version=2'))
+        self.assertEqual(views.cached_page.calls, calls + 1)
+        views.cached_page(self.factory.get('/'))
+        views.cached_page(self.factory.get('/'))
+        self.assertEqual(views.cached_page.calls, calls + 3)
+
+    def test_options(self):
+        calls = []
+        @decorators.json_response(cache_key=lambda request: 'key')
+        def keyed(request):
+            calls.append(request)
+            return dict()
+        @decorators.template_response(
+            'testapp/message.html', cache_seconds=60
+            )
+        def page(request):
+            calls.append(request)
+            return dict(message='hi')
+        for view in (keyed, page):
+            calls[:] = []
+            view(self.factory.get('/options/'))
+            view(self.factory.get('/options/'))
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(view.cache_stats['hits'], 1)
+        self.assertRaises(
+            TypeError, decorators.json_response, cache='default'
+            )
+        self.assertRaises(
+            TypeError, decorators.template_response,
+            'testapp/message.html', cache='default'
+            )
+
+    def test_csrf(self):
+        calls = []
+        @decorators.template_response(
+            'testapp/csrf.html', cache_key=lambda request: 'csrf'
+            )
+        def csrf_page(request):
+            calls.append(request)
+            return dict()
+        @decorators.template_response(
+            'testapp/csrf_fragment.html', cache_key=lambda request: 'csrf',
+            fragments=dict(csrf=decorators.csrf_fragment)
+            )
+        def csrf_fragment_page(request):
+            calls.append(request)
+            return dict()
+
+        for view, expected_calls in ((csrf_page, 2), (csrf_fragment_page, 1)):
+            calls[:] = []
+            for token in ('a' * 32, 'b' * 32):
+                request = self.factory.get('/')
+                request.META['CSRF_COOKIE'] = token
+                response = view(request)
+                self.assertTrue("value='%s'" % token in response.content)
+                self.assertTrue(request.META.get('CSRF_COOKIE_USED'))
+            self.assertEqual(len(calls), expected_calls)
+
+class TestGzip(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def decompress(self, content):
+        return json.loads(zlib.decompress(content, zlib.MAX_WBITS | 16))
+
+    def test_gzip(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = views.long_message(request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertEqual(
+            self.decompress(response.content)['message'], 'hello ' * 100
+            )
+
+    def test_threshold(self):
+        request = self.factory.get(
+            '/?repeat=2', HTTP_ACCEPT_ENCODING='gzip'
+            )
+        response = views.long_message(request)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_not_accepted(self):
+        response = views.long_message(self.factory.get('/'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_stream(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        response = views.stream_numbers(request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = self.decompress(''.join(response))
+        self.assertEqual(data['numbers'], range(1000))
+
+    def test_short_stream(self):
+        request = self.factory.get('/?count=2', HTTP_ACCEPT_ENCODING='gzip')
+        response = views.stream_numbers(request)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(''.join(response))['numbers'], [0, 1])
+
+class TestTiming(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_json(self):
+        with self.settings(DEBUG=True):
+            response = views.timed_models(self.factory.get('/'))
+        header = response['Server-Timing']
+        self.assertTrue(header.startswith('view;dur='))
+        self.assertTrue('serialize;dur=' in header)
+        self.assertTrue('db;dur=' in header)
+        self.assertTrue('desc="1 queries"' in header)
+        name, timings = views.collect_timings.collected[-1]
+        self.assertEqual(name, 'timed_models')
+        self.assertEqual(timings['queries'], 1)
+        self.assertTrue(timings['total'] >= timings['view'])
+
+    def test_stream(self):
+        timings = []
+        @decorators.json_response(
+            stream=True, etag=True,
+            timing=lambda request, view, figures: timings.append(figures)
+            )
+        def view(request):
+            return dict(models=models.TestModel.objects.values('id'))
+        with self.settings(DEBUG=True):
+            response = view(self.factory.get('/'))
+        header = response['Server-Timing']
+        self.assertFalse('serialize;dur=' in header)
+        self.assertFalse('db;dur=' in header)
+        self.assertTrue('etag;dur=' in header)
+        self.assertEqual(
+            sorted(timings[0]), ['etag', 'total', 'view']
+            )
+        self.assertEqual(json.loads(''.join(response))['models'], [])
+
+    def test_template(self):
+        response = views.timed_page(self.factory.get('/'))
+        header = response['Server-Timing']
+        self.assertTrue('render;dur=' in header)
+        self.assertFalse('db;dur=' in header)
+
+class TestProfileView(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def profiled(self, **kws):
+        @decorators.profile_view(directory=self.directory, **kws)
+        def view(request):
+            return http.HttpResponse('hello')
+        return view
+
+    def test_sample(self):
+        view = self.profiled(sample=1, keep=2)
+        for i in range(3):
+            self.assertEqual(view(self.factory.get('/')).content, 'hello')
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].startswith('testapp.tests.view-'))
+        stats = decorators.aggregate_profiles(
+            self.directory, 'testapp.tests.view'
+            )
+        self.assertEqual(stats.total_calls > 0, True)
+
+    def test_unwritable(self):
+        # The directory can't be created under a file.
+        path = os.path.join(self.directory, 'file')
+        open(path, 'w').close()
+        @decorators.profile_view(
+            sample=1, directory=os.path.join(path, 'profiles')
+            )
+        def view(request):
+            return http.HttpResponse('hello')
+        logger = logging.getLogger('dj_utils.decorators')
+        logger.disabled = True
+        try:
+            self.assertEqual(view(self.factory.get('/')).content, 'hello')
+        finally:
+            logger.disabled = False
+
+    def test_signed_header(self):
+        view = self.profiled(sample=None)
+        view(self.factory.get('/'))
+        self.assertEqual(os.listdir(self.directory), [])
+        view(self.factory.get('/', HTTP_X_PROFILE='forged'))
+        self.assertEqual(os.listdir(self.directory), [])
+        token = decorators.profile_request_token()
+        view(self.factory.get('/', HTTP_X_PROFILE=token))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+class TestConcurrencyLimit(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def limited(self, **kws):
+        @decorators.concurrency_limit(1, **kws)
+        def view(request):
+            self.entered.set()
+            self.release.wait(5)
+            return http.HttpResponse('done')
+        return view
+
+    def start(self, view):
+        thread = threading.Thread(target=view, args=(self.factory.get('/'),))
+        thread.start()
+        self.entered.wait(5)
+        return thread
+
+    def test_reject(self):
+        view = self.limited(retry_after=3)
+        thread = self.start(view)
+        response = view(self.factory.get('/'))
+        self.release.set()
+        thread.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertEqual(json.loads(response.content)['ok'], False)
+        self.assertEqual(
+            view.limit_stats.as_dict(),
+            dict(accepted=1, queued=0, rejected=1)
+            )
+
+    def test_queue(self):
+        view = self.limited(queue_timeout=5)
+        thread = self.start(view)
+        threading.Timer(0.1, self.release.set).start()
+        response = view(self.factory.get('/'))
+        thread.join()
+        self.assertEqual(response.content, 'done')
+        self.assertEqual(view.limit_stats['queued'], 1)
+
+class TestCoalesce(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_coalesce(self):
+        entered = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @decorators.json_response(coalesce=True)
+        def view(request):
+            calls.append(request)
+            entered.set()
+            release.wait(5)
+            return dict(count=len(calls))
+
+        responses = []
+        def fetch():
+            responses.append(view(self.factory.get('/photos/?page=1')))
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        threads[0].start()
+        entered.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            [json.loads(r.content)['count'] for r in responses], [1] * 4
+            )
+        self.assertEqual(
+            set(r['Content-Type'] for r in responses),
+            set(['application/json'])
+            )
+
+    def run_waiting(self, view, count=3):
+        # Calls the view in 'count' threads, the first of which is
+        # still in the view when the others start.
+        results = []
+        def fetch():
+            try:
+                results.append(view(self.factory.get('/x/')))
+            except Exception, err:
+                results.append(err)
+        threads = [threading.Thread(target=fetch) for i in range(count)]
+        threads[0].start()
+        view.entered.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        view.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def waiting_view(self, result):
+        @decorators.json_response(coalesce=True)
+        def view(request):
+            view.calls.append(request)
+            view.entered.set()
+            view.release.wait(5)
+            return result()
+        view.calls = []
+        view.entered = threading.Event()
+        view.release = threading.Event()
+        return view
+
+    def test_passthrough(self):
+        def result():
+            response = http.HttpResponse('done', status=201)
+            response.set_cookie('seen', 'yes')
+            return response
+        view = self.waiting_view(result)
+        responses = self.run_waiting(view)
+        self.assertEqual(len(view.calls), 1)
+        for response in responses:
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.content, 'done')
+            self.assertEqual(response.cookies['seen'].value, 'yes')
+        responses[1].cookies['seen'] = 'no'
+        self.assertEqual(responses[2].cookies['seen'].value, 'yes')
+
+    def test_error(self):
+        def result():
+            raise ValueError('failed')
+        view = self.waiting_view(result)
+        errors = self.run_waiting(view)
+        self.assertEqual(len(view.calls), 1)
+        self.assertEqual([str(error) for error in errors], ['failed'] * 3)
+
+    def test_different_keys(self):
+        @decorators.json_response(coalesce='user')
+        def view(request):
+            return dict(path=request.get_full_path())
+        response = view(self.factory.get('/a/'))
+        self.assertEqual(json.loads(response.content)['path'], '/a/')
+        response = view(self.factory.post('/b/'))
+        self.assertEqual(json.loads(response.content)['path'], '/b/')
+
+class TestBatch(TestCase):
+    def post(self, url, data):
+        response = self.client.post(
+            url, json.dumps(data), content_type='application/json'
+            )
+        return json.loads(response.content)
+
+    def test_batch(self):
+        models.TestModel.objects.create(privacy=2)
+        data = self.post('/testapp/batch/', [
+            dict(path='/testapp/message/', params=dict(message='hi')),
+            dict(path='/testapp/models/'),
+            dict(path='/testapp/page/'),
+            dict(path='/testapp/missing/'),
+            dict(method='DELETE', path='/testapp/message/'),
+            ])
+        self.assertEqual(data['ok'], True)
+        results = data['results']
+        self.assertEqual(
+            [r['status'] for r in results], [200, 200, 200, 404, 405]
+            )
+        self.assertEqual(results[0]['body'], dict(ok=True, message='hi'))
+        self.assertEqual(results[1]['body']['models'][0]['privacy'], 2)
+        self.assertEqual(results[2]['body'], '<p>hello</p>\n')
+
+    def test_post(self):
+        data = self.post('/testapp/post-batch/', [
+            dict(method='POST', path='/testapp/echo/', params=dict(a=1)),
+            dict(path='/testapp/echo/', params=dict(a=2)),
+            dict(method=u'P\xd3ST', path='/testapp/echo/'),
+            dict(method=1, path='/testapp/echo/'),
+            ])
+        results = data['results']
+        self.assertEqual(
+            [r['status'] for r in results], [200, 200, 400, 400]
+            )
+        self.assertEqual(results[0]['body'], dict(
+            ok=True, body='a=1', post=dict(a='1'), files=0,
+            content_type='application/x-www-form-urlencoded'
+            ))
+        self.assertEqual(results[1]['body']['body'], '')
+
+    def test_no_compression(self):
+        response = self.client.post(
+            '/testapp/batch/',
+            json.dumps([dict(path='/testapp/long/')]),
+            content_type='application/json', HTTP_ACCEPT_ENCODING='gzip'
+            )
+        body = json.loads(response.content)['results'][0]['body']
+        self.assertEqual(body['message'], 'hello ' * 100)
+
+    def test_parallel(self):
+        data = self.post('/testapp/parallel-batch/', dict(requests=[
+            dict(path='/testapp/message/', params=dict(message=str(i)))
+            for i in range(3)
+            ]))
+        self.assertEqual(
+            [r['body']['message'] for r in data['results']], ['0', '1', '2']
+            )
+
+    def test_limits(self):
+        data = self.post('/testapp/parallel-batch/', [{}] * 4)
+        self.assertEqual(data['ok'], False)
+        response = self.client.get('/testapp/batch/')
+        self.assertEqual(response.status_code, 405)
+
+class TestProjection(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.ids = [
+            models.TestModel.objects.create(
+                privacy=privacy, restricted_slug='a-%d' % privacy
+                ).id
+            for privacy in (2, 0)
+            ]
+
+    def test_project(self):
+        response = views.projected_models(self.factory.get('/'))
+        self.assertEqual(json.loads(response.content)['models'], [
+            dict(id=self.ids[0], privacy=2), dict(id=self.ids[1], privacy=0)
+            ])
+
+    def test_stream(self):
+        response = views.stream_projected_models(self.factory.get('/'))
+        rows = json.loads(''.join(response))['models']
+        self.assertEqual(
+            sorted(rows),
+            [dict(privacy=0, restricted_slug='a-0'),
+             dict(privacy=2, restricted_slug='a-2')]
+            )
+
+    def test_html(self):
+        response = views.projected_models(
+            self.factory.get('/', dict(format='html'))
+            )
+        self.assertTrue("<th>privacy:</th>" in response.content)
+
+    def test_row_encoder(self):
+        encoder = encoders.RowEncoder(['a', u'b"%', 'c', 'd', 'e'])
+        values = (1, u'\xe9', None, True, 1.5)
+        self.assertEqual(
+            json.loads(encoder.encode_values(values)),
+            json.loads(json.dumps(dict(zip(encoder.keys, values))))
+            )
+
+class TestShapeEncoder(TestCase):
+    def test_rows(self):
+        encoder = encoders.ShapeEncoder()
+        rows = [
+            dict(a=1, b=u'\xe9'), dict(a=None, b='x'), dict(a=2, b=u'y'),
+            dict(a=1), dict(a=1, c=2), dict(a=[1.5], b=dict(c=True)),
+            dict(a=xrange(1, 3), b=1), dict(a=3, b=u'z')
+            ]
+        for row in rows:
+            self.assertEqual(
+                json.loads(encoder.encode(row)),
+                json.loads(encoders.encode(row))
+                )
+        self.assertEqual(encoder.keys, ('a', 'b'))
+
+    def test_empty_rows(self):
+        self.assertEqual(encoders.ShapeEncoder().encode({}), '{}')
+        self.assertEqual(
+            encoders.RowEncoder([]).encode_values(()), '{}'
+            )
+        self.assertEqual(
+            json.loads(encoders.encode(iter([{}, dict(a=1), {}]))),
+            [{}, dict(a=1), {}]
+            )
+        @decorators.json_response(stream=True)
+        def view(request):
+            return dict(rows=iter([{}, {}]))
+        response = view(RequestFactory().get('/'))
+        self.assertEqual(json.loads(''.join(response))['rows'], [{}, {}])
+
+    def test_declared_keys(self):
+        encoder = encoders.ShapeEncoder(['b', 'a'])
+        self.assertEqual(
+            encoder.encode_rows([dict(a=1, b=2), dict(a=3, b=4)]),
+            '[{"b": 2, "a": 1}, {"b": 4, "a": 3}]'
+            )
+
+    def test_stream(self):
+        rows = [dict(a=i, b=[i]) if i % 3 else dict(a=i) for i in range(10)]
+        self.assertEqual(
+            json.loads(encoders.encode(iter(rows + [1, [2]]))),
+            rows + [1, [2]]
+            )
+
+class CountingIterable(object):
+    # Counts the times an encoder checks whether it is iterable.
+    checked = 0
+    def __init__(self, items):
+        self.items = items
+    def __getattribute__(self, name):
+        if name == '__iter__':
+            CountingIterable.checked += 1
+        return object.__getattribute__(self, name)
+    def __iter__(self):
+        return iter(self.items)
+
+class TestIterencode(TestCase):
+    def test_deep_iterator(self):
+        # The old encoder tried the whole value at every level above
+        # the iterator, before finding it.
+        value = node = {}
+        for i in range(5):
+            node['numbers'] = range(10)
+            node['next'] = node = {}
+        node['numbers'] = CountingIterable([1, iter([2])])
+        CountingIterable.checked = 0
+        decoded = json.loads(''.join(encoders.iterencode(value)))
+        self.assertEqual(CountingIterable.checked, 1)
+        for i in range(5):
+            self.assertEqual(decoded['numbers'], range(10))
+            decoded = decoded['next']
+        self.assertEqual(decoded, dict(numbers=[1, [2]]))
+
+    def test_placeholder_like(self):
+        text = u'\x00abc:0'
+        self.assertEqual(
+            json.loads(encoders.encode([text, iter([text])])), [text, [text]]
+            )
+
+class TestCBOR(TestCase):
+    def test_vectors(self):
+        # Examples from RFC 7049, appendix A.
+        for value, encoded in [
+                (0, '00'), (23, '17'), (100, '1864'), (1000000, '1a000f4240'),
+                (18446744073709551615, '1bffffffffffffffff'),
+                (18446744073709551616, 'c249010000000000000000'),
+                (-1, '20'), (-1000, '3903e7'), (100000.0, 'fa47c35000'),
+                (1.1, 'fb3ff199999999999a'), (False, 'f4'), (None, 'f6'),
+                (u'\xfc', '62c3bc'), ('a', '6161'), (dict(a=1), 'a1616101'),
+                ([1, [2, 3]], '8201820203'), (bytearray('\x01'), '4101'),
+                ]:
+            self.assertEqual(
+                encoders.encode_cbor(value).encode('hex'), encoded
+                )
+
+    def test_iterators(self):
+        value = dict(a=(i for i in [1, 2]))
+        self.assertEqual(
+            encoders.encode_cbor(value).encode('hex'), 'a161619f0102ff'
+            )
+        self.assertEqual(
+            ''.join(encoders.iterencode_cbor([iter([1])])).encode('hex'),
+            '819f01ff'
+            )
+
+    def test_negotiate(self):
+        self.assertEqual(encoders.negotiate(None), encoders.JSON)
+        self.assertEqual(encoders.negotiate('*/*'), encoders.JSON)
+        self.assertEqual(
+            encoders.negotiate('application/json;q=0.5, application/cbor'),
+            encoders.CBOR
+            )
+        self.assertEqual(
+            encoders.negotiate('application/cbor, application/json'),
+            encoders.JSON
+            )
+
+    def test_response(self):
+        factory = RequestFactory()
+        request = factory.get('/', HTTP_ACCEPT='application/cbor')
+        response = views.negotiated(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Content-Type'], 'application/cbor')
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertEqual(
+            response.content,
+            encoders.encode_cbor(dict(ok=True, numbers=[1, 2]))
+            )
+        request = factory.get(
+            '/', dict(callback='cb'), HTTP_ACCEPT='application/cbor'
+            )
+        response = views.negotiated(request)
+        self.assertEqual(response['Content-Type'], 'application/javascript')
+
+class TestSettingsUtils(TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.pop('DJANGO_MACHINE_ID', None)
+        self.directory = tempfile.mkdtemp()
+        settings_utils.reset_environment()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+        settings_utils.reset_environment()
+
+    def test_override(self):
+        settings_utils.set_environment('bob_mac')
+        self.assertEqual(
+            settings_utils.config('x', bob_mac='y', ian_linux='z'), 'y'
+            )
+        self.assertEqual(settings_utils.config('x', ian_linux='z'), 'x')
+
+    def test_search_path(self):
+        with open(os.path.join(self.directory, '.machine_id'), 'w') as out:
+            out.write('ian_linux\n')
+        os.environ['DJANGO_MACHINE_ID_PATH'] = os.pathsep.join([
+            os.path.join(self.directory, 'missing'), self.directory
+            ])
+        value = settings_utils.lazy_config('x', ian_linux='z')
+        self.assertEqual(
+            settings_utils.timing_report(), "Machine id not resolved yet."
+            )
+        self.assertEqual(value + '!', 'z!')
+        self.assertTrue('(2 paths searched)' in settings_utils.timing_report())
+
+    def test_skips_packages(self):
+        os.environ.pop('DJANGO_MACHINE_ID_PATH', None)
+        path = settings_utils.search_path()
+        self.assertFalse([entry for entry in path if 'site-packages' in entry])
+
+    def test_packages_fallback(self):
+        os.environ.pop('DJANGO_MACHINE_ID_PATH', None)
+        packages = os.path.join(self.directory, 'site-packages')
+        os.mkdir(packages)
+        with open(os.path.join(packages, '.machine_id'), 'w') as out:
+            out.write('bob_mac\n')
+        sys.path.append(packages)
+        try:
+            self.assertEqual(settings_utils.environment(), 'bob_mac')
+        finally:
+            sys.path.remove(packages)
+
+class TestMetrics(TestCase):
+    def tearDown(self):
+        metrics.disable()
+
+    def test_disabled(self):
+        self.assertEqual(metrics.collector, None)
+        models.TestModel(json_data=[1], pickle_data=[2]).save()
+        self.assertEqual(metrics.dump(), "Metrics are disabled.\n")
+
+    def test_memory(self):
+        collector = metrics.enable()
+        m = models.TestModel(json_data=dict(a=[1] * 100), pickle_data=[2])
+        m.save()
+        m = models.TestModel.objects.get(id=m.id)
+        self.assertEqual(m.json_data, dict(a=[1] * 100))
+        stats = collector.stats
+        for field, operation in [
+                ('json_data', 'encode'), ('json_data', 'decode'),
+                ('pickle_data', 'encode'), ('pickle_data', 'decode'),
+                ('ido', 'obfuscate')
+                ]:
+            self.assertTrue(
+                stats[('testapp.TestModel', field, operation)]['count'] >= 1
+                )
+        encode = stats[('testapp.TestModel', 'json_data', 'encode')]
+        self.assertEqual(encode['raw'].keys(), [512])
+        self.assertTrue('testapp.TestModel.json_data' in metrics.dump())
+        self.assertTrue('raw     bytes: <=512: ' in metrics.dump())
+
+    def test_custom(self):
+        class Counter(metrics.Collector):
+            calls = []
+            def record(self, *args):
+                self.calls.append(args[:3])
+        metrics.enable(Counter())
+        models.TestModel(json_data=[1]).save()
+        self.assertTrue(
+            ('testapp.TestModel', 'json_data', 'encode') in Counter.calls
+            )
+        self.assertEqual(metrics.dump(), "Counter doesn't keep metrics.\n")
+
+class TestReplicas(TestCase):
+    # The replica is an empty database of its own in the tests, so
+    # reads that go to it don't see the models saved here.
+    def setUp(self):
+        self.factory = RequestFactory()
+        models.TestModel(json_data=[1]).save()
+
+        @decorators.method_required('GET', replica=True)
+        def count(request):
+            count = models.TestModel.objects.count()
+            if 'write' in request.GET:
+                models.TestModel(json_data=[2]).save()
+                count = (count, models.TestModel.objects.count())
+            return count
+        self.view = count
+
+    def test_replica(self):
+        self.assertEqual(self.view(self.factory.get('/')), 0)
+        self.assertEqual(models.TestModel.objects.count(), 1)
+        self.assertEqual(
+            self.view(self.factory.post('/')).status_code, 405
+            )
+
+    def test_write(self):
+        self.assertEqual(self.view(self.factory.get('/?write')), (0, 2))
+        self.assertEqual(
+            models.TestModel.objects.using('replica').count(), 0
+            )
+
+        # An object read from the replica is saved to the primary.
+        m = models.TestModel.objects.order_by('-id')[0]
+        m._state.db = 'replica'
+        m.save()
+        self.assertEqual(m._state.db, 'default')
+        self.assertEqual(
+            models.TestModel.objects.using('replica').count(), 0
+            )
+
+    def test_sticky(self):
+        middleware = replicas.StickyPrimaryMiddleware()
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        response = middleware.process_response(request, http.HttpResponse())
+        self.assertFalse(replicas.COOKIE_NAME in response.cookies)
+
+        request = self.factory.post('/')
+        middleware.process_request(request)
+        response = middleware.process_response(request, http.HttpResponse())
+        cookie = response.cookies[replicas.COOKIE_NAME]
+        self.assertEqual(cookie['max-age'], 5)
+
+        request = self.factory.get('/')
+        request.COOKIES[replicas.COOKIE_NAME] = cookie.value
+        self.assertEqual(self.view(request), 1)
@@ -0,0 +1,16 @@
+from django.conf.urls.defaults import patterns, url
+
+from dj_utils.batch import batch_view
+
+import views
+
+urlpatterns = patterns('',
+    url(r'^message/$', views.message),
+    url(r'^page/$', views.message_page),
+    url(r'^models/$', views.stream_models),
+    url(r'^long/$', views.long_message),
+    url(r'^batch/$', batch_view()),
+    url(r'^parallel-batch/$', batch_view(threads=4, max_requests=3)),
+    url(r'^post-batch/$', batch_view(methods=('GET', 'POST'))),
+    url(r'^echo/$', views.echo),
+)
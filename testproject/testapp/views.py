@@ -1 +1,89 @@
-# Create your views here.
+import dj_utils.decorators as decorators
+
+import models
+
+@decorators.json_response(stream=True)
+def stream_models(request):
+    return dict(
+        models=models.TestModel.objects.order_by('id').values('id', 'privacy'),
+        count=(i * i for i in range(3))
+        )
+
+@decorators.json_response(etag=True)
+def message(request):
+    return dict(message=request.GET.get('message', 'hello'))
+
+def message_version(request):
+    return request.GET.get('version')
+
+@decorators.json_response(etag=message_version)
+def versioned_message(request):
+    versioned_message.calls += 1
+    return dict(message='hello')
+versioned_message.calls = 0
+
+@decorators.template_response('testapp/message.html', etag=True)
+def message_page(request):
+    return dict(message='hello')
+
+def page_version(request):
+    return request.GET.get('version')
+
+def greeting(request):
+    return '<b>hi %s</b>' % request.GET.get('name', 'there')
+
+@decorators.template_response(
+    'testapp/cached.html', cache_key=page_version,
+    fragments=dict(greeting=greeting)
+    )
+def cached_page(request):
+    cached_page.calls += 1
+    return dict(message='hello %d' % cached_page.calls)
+cached_page.calls = 0
+
+@decorators.json_response(cache_seconds=60)
+def cached_message(request):
+    cached_message.calls += 1
+    return dict(message=request.GET.get('message', 'hello'))
+cached_message.calls = 0
+
+@decorators.json_response(gzip=True, gzip_threshold=100, etag=True)
+def long_message(request):
+    return dict(message='hello ' * int(request.GET.get('repeat', 100)))
+
+@decorators.json_response(stream=True, gzip=True, gzip_threshold=100)
+def stream_numbers(request):
+    return dict(numbers=iter(xrange(int(request.GET.get('count', 1000)))))
+
+def collect_timings(request, view, timings):
+    collect_timings.collected.append((view.__name__, timings))
+collect_timings.collected = []
+
+@decorators.json_response(timing=collect_timings)
+def timed_models(request):
+    return dict(count=models.TestModel.objects.count())
+
+@decorators.template_response('testapp/message.html', timing=True)
+def timed_page(request):
+    return dict(message='hello')
+
+@decorators.json_response(project=dict(models=('id', 'privacy')))
+def projected_models(request):
+    return dict(models=models.TestModel.objects.order_by('id'))
+
+@decorators.json_response(
+    stream=True, project=dict(models=('privacy', 'restricted_slug'))
+    )
+def stream_projected_models(request):
+    return dict(models=models.TestModel.objects)
+
+@decorators.json_response(negotiate=True)
+def negotiated(request):
+    return dict(numbers=[1, 2], status=201)
+
+@decorators.json_response()
+def echo(request):
+    return dict(
+        body=request.body, content_type=request.META.get('CONTENT_TYPE'),
+        post=request.POST.dict(), files=len(request.FILES)
+        )